@@ -6,13 +6,23 @@
 		this.token = null;
 		this.myEstimates = {};
 		this.game = null;
+		this.deck = null;
+		this.version = null;
 		this.channel = null;
 		this.channelId = null;
+		this.shared = null;
+		this.connected = null;
+		this.disconnected = null;
+		this.presence = null;
 		
 		this.init(element);
 	};
 	
-	Poker.VERSION = '1.1.0';
+	Poker.VERSION = '1.2.0';
+	
+	Poker.PRESENCE_INTERVAL = 5 * 60 * 1000;
+	
+	Poker.FORMAT = 2;
 	
 	Poker.prototype.init = function(element) {
 		this.$game = $(element);
@@ -20,7 +30,9 @@
 		this.me = this.$game.data('me');
 		this.token = this.$game.data('token');
 		this.channelId = this.$game.data('channel-id');
-		this.game = this.$game.data('initial-message');
+		this.deck = this.$game.data('deck');
+		this.game = this.decode(this.$game.data('initial-message'));
+		this.version = this.game ? this.game.version : null;
 		
 		this.setup();
 		
@@ -43,6 +55,17 @@
 	
 	Poker.prototype.closeGame = function() {
 		this.channel.off();
+		
+		if(this.shared) {
+			this.shared.off();
+		}
+		
+		if(this.connected) {
+			this.connected.off();
+		}
+		
+		clearInterval(this.presence);
+		
 		$.post(this.gameUrl + '/closed');
 	};
 	
@@ -122,25 +145,169 @@
 	
 	Poker.prototype.onValue = function() {
 		this.channel = firebase.database().ref('channels/' + this.channelId);
-		this.channel.on('value', $.proxy(this.onMessage, this));
+		this.channel.onDisconnect().remove();
+		this.channel.on('value', $.proxy(this.onChannel, this));
+		
+		this.connected = firebase.database().ref('.info/connected');
+		this.connected.on('value', $.proxy(this.onConnected, this));
 		
 		this.onOpened();
 	};
 	
+	Poker.prototype.onConnected = function(data) {
+		if(!data.val()) {
+			if(this.disconnected === false) {
+				this.disconnected = true;
+			}
+			
+			return;
+		}
+		
+		if(this.disconnected) {
+			this.channel.onDisconnect().remove();
+			this.requestSnapshot();
+		}
+		
+		this.disconnected = false;
+	};
+	
+	Poker.prototype.onChannel = function(data) {
+		var message = data.val();
+		
+		if(message && message.game !== undefined) {
+			this.openShared(message.game);
+		} else {
+			this.onMessage(data);
+		}
+	};
+	
+	Poker.prototype.openShared = function(gameId) {
+		if(this.shared) {
+			
+			return;
+		}
+		
+		this.shared = firebase.database().ref('games/' + gameId);
+		this.shared.on('value', $.proxy(this.onMessage, this));
+	};
+	
 	Poker.prototype.onOpened = function() {
-		$.post(this.gameUrl + '/opened', $.proxy(this.initMyEstimates, this));
+		$.post(this.gameUrl + '/opened', {format: Poker.FORMAT}, $.proxy(this.initMyEstimates, this));
+		
+		this.presence = setInterval($.proxy(this.sendPresence, this), Poker.PRESENCE_INTERVAL);
+	};
+	
+	Poker.prototype.sendPresence = function() {
+		$.post(this.gameUrl + '/presence');
 	};
 	
 	Poker.prototype.initMyEstimates = function(data) {
 		this.myEstimates = data.estimates;
 	};
 	
+	Poker.prototype.decode = function(message) {
+		if(!message || message.f !== Poker.FORMAT) {
+			
+			return message;
+		}
+		
+		var gameUrl = this.gameUrl;
+		var users = message.us || [];
+		var currentId = message.cs ? message.cs.i : null;
+		var list = function(items, decode) {
+			var decoded = [];
+			
+			for(var index in items || []) {
+				decoded.push(decode(items[index]));
+			}
+			
+			return decoded;
+		};
+		var user = function(index) {
+			return users[index] || [];
+		};
+		var value = function(value) {
+			return value === undefined ? null : value;
+		};
+		var estimate = function(entry) {
+			return {
+				user: user(entry.u)[0],
+				name: value(entry.n === undefined ? user(entry.u)[1] : entry.n),
+				card: value(entry.c)
+			};
+		};
+		var story = function(entry) {
+			var url = gameUrl + '/story/' + entry.i;
+			
+			if(entry.i === currentId && currentStory) {
+				// Only the current story entry carries the rounds.
+				return currentStory;
+			}
+			
+			return {
+				id: entry.i,
+				name: entry.n,
+				estimate: value(entry.e),
+				url: url,
+				is_current: entry.i === currentId,
+				rounds: list(entry.r, function(round) {
+					return {
+						id: round.i,
+						completed: !!round.c,
+						url: url + '/round/' + round.i,
+						estimates: list(round.e, estimate),
+						stats: value(round.s)
+					};
+				})
+			};
+		};
+		
+		var currentStory = message.cs ? story(message.cs) : null;
+		
+		return {
+			id: message.i,
+			name: message.n,
+			deck: this.deck,
+			completed: !!message.c,
+			user: user(message.u)[0],
+			current_story: currentStory,
+			url: gameUrl,
+			participants: list(message.p, function(participant) {
+				var userId = user(participant.u)[0];
+				
+				return {
+					user: userId,
+					name: value(participant.n === undefined ? user(participant.u)[1] : participant.n),
+					photo: value(participant.p),
+					observer: !!participant.o,
+					url: gameUrl + '/participant/' + message.i + userId
+				};
+			}),
+			stories: list(message.s, story),
+			version: message.v,
+			totals: value(message.t)
+		};
+	};
+	
 	Poker.prototype.onMessage = function(data) {
-		this.game = data.val();
+		var game = this.decode(data.val());
+		
+		if(game && (game.id === undefined || game.version < this.version)) {
+			this.requestSnapshot();
+			
+			return;
+		}
+		
+		this.game = game;
+		this.version = game ? game.version : null;
 		
 		this.updateGame();
 	};
 	
+	Poker.prototype.requestSnapshot = function() {
+		$.post(this.gameUrl + '/opened', {snapshot: 1, format: Poker.FORMAT}, $.proxy(this.initMyEstimates, this));
+	};
+	
 	Poker.prototype.onError = function(error) {
 		console.log(error.code);
 		console.log(error.message);
@@ -173,6 +340,16 @@
 		for(var key in this.game.stories) {
 			this.updateStory(this.game.stories[key], $stories);
 		}
+		
+		this.showTotals();
+	};
+	
+	Poker.prototype.showTotals = function() {
+		var $sum = this.$game.find('[data-game="sum-of-estimates"]');
+		
+		if(this.game.totals && this.game.totals.estimate > 0) {
+			$sum.text(this.game.totals.estimate);
+		}
 	};
 	
 	Poker.prototype.clearSum = function() {
@@ -202,7 +379,9 @@
 			}
 		}
 		
-		this.addToSum(story);
+		if(!this.game.totals) {
+			this.addToSum(story);
+		}
 	};
 	
 	Poker.prototype.addToSum = function(story) {
@@ -426,6 +605,10 @@
 				.addClass('sum-of-estimates')
 				.append($sum)
 				.appendTo($estimate);
+			
+			if(round.stats && round.stats.counts && round.stats.counts[index] > 0) {
+				$sum.text(round.stats.counts[index]);
+			}
 		}
 		
 		for(var key in round.estimates) {
@@ -462,6 +645,11 @@
 				.append($photo)
 				.appendTo($estimate);
 			
+			if(round.stats) {
+				
+				continue;
+			}
+			
 			$sum = $estimate
 				.find('[data-card="sum-of-estimates"]');
 			
@@ -473,6 +661,30 @@
 			
 			$sum.text(sum + 1);
 		}
+		
+		this.roundStats(round, $round);
+	};
+	
+	Poker.prototype.roundStats = function(round, $round) {
+		var stats = round.stats;
+		
+		if(!stats || stats.mean == null) {
+			return;
+		}
+		
+		var $stats = $('<ul class="list-inline text-muted" data-game="round-stats"></ul>')
+			.appendTo($round);
+		
+		$('<li>').text('Average: ' + stats.mean).appendTo($stats);
+		$('<li>').text('Median: ' + stats.median).appendTo($stats);
+		$('<li>').text('Mode: ' + stats.mode).appendTo($stats);
+		$('<li>').text('Spread: ' + stats.min + ' - ' + stats.max).appendTo($stats);
+		
+		if(stats.consensus) {
+			$('<li>')
+				.append('<span class="label label-success">Consensus</span>')
+				.appendTo($stats);
+		}
 	};
 	
 	Poker.prototype.gameActions = function() {
@@ -636,6 +848,7 @@
 	};
 	
 	$.fn.poker = Plugin;
+	$.fn.poker.Constructor = Poker;
 	
 	$(window).on('load', function() {
 		$('[data-game="poker"]').each(function() {
@@ -0,0 +1,44 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+
+# Point GAE_SDK at the google_appengine directory of the Cloud SDK.
+if os.environ.get('GAE_SDK'):
+    sys.path.insert(0, os.environ['GAE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+from google.appengine.api import users
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+__all__ = [
+    'ROOT',
+    'create_testbed',
+    'create_user',
+]
+
+def create_testbed():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_app_identity_stub()
+    bed.init_urlfetch_stub()
+    bed.init_taskqueue_stub(root_path = ROOT)
+    ndb.get_context().clear_cache()
+    return bed
+
+def create_user(index):
+    return users.User(
+        email = 'user{}@example.com'.format(index),
+        _user_id = str(100000 + index)
+    )
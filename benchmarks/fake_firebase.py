@@ -0,0 +1,136 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from collections import Counter
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+__all__ = [
+    'FakeFirebase',
+]
+
+def store(value):
+    # Firebase keeps arrays as objects keyed by index and drops nulls, so a
+    # PATCH can address single array items.
+    if isinstance(value, list):
+        value = dict((str(index), item) for index, item in enumerate(value))
+    if isinstance(value, dict):
+        items = ((str(key), store(item)) for key, item in value.items())
+        return dict((key, item) for key, item in items if item is not None) or None
+    return value
+
+def load(value):
+    # Objects whose keys are mostly sequential indexes read back as arrays.
+    if not isinstance(value, dict):
+        return value
+    value = dict((key, load(item)) for key, item in value.items())
+    if value and all(key.isdigit() for key in value):
+        size = max(int(key) for key in value) + 1
+        if len(value) * 2 > size:
+            return [value.get(str(index)) for index in range(size)]
+    return value
+
+class FirebaseRequestHandler(BaseHTTPRequestHandler):
+
+    def get_path(self):
+        path = self.path.split('?', 1)[0]
+        if path.endswith('.json'):
+            path = path[:-len('.json')]
+        return [part for part in path.split('/') if part]
+
+    def get_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        self.server.count(self.command, len(body))
+        return json.loads(body) if body else None
+
+    def respond(self, value):
+        content = json.dumps(value)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.server.count('GET', 0)
+        self.respond(self.server.get(self.get_path()))
+
+    def do_PUT(self):
+        value = self.get_body()
+        self.server.set(self.get_path(), value)
+        self.respond(value)
+
+    def do_PATCH(self):
+        value = self.get_body()
+        path = self.get_path()
+        for child, child_value in (value or {}).items():
+            self.server.set(path + [part for part in child.split('/') if part], child_value)
+        self.respond(value)
+
+    def do_DELETE(self):
+        self.get_body()
+        self.server.set(self.get_path(), None)
+        self.respond(None)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeFirebase(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port = 0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FirebaseRequestHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.requests = Counter()
+        self.bytes = 0
+
+    def get_url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def count(self, method, size):
+        with self.lock:
+            self.requests[method] += 1
+            self.bytes += size
+
+    def get(self, path):
+        with self.lock:
+            node = self.data
+            for part in path:
+                if not isinstance(node, dict) or part not in node:
+                    return None
+                node = node[part]
+            return load(node)
+
+    def set(self, path, value):
+        value = store(value)
+        with self.lock:
+            if not path:
+                self.data = value if isinstance(value, dict) else {}
+                return
+            node = self.data
+            for part in path[:-1]:
+                if not isinstance(node.get(part), dict):
+                    node[part] = {}
+                node = node[part]
+            if value is None:
+                node.pop(path[-1], None)
+            else:
+                node[path[-1]] = value
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
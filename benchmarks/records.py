@@ -0,0 +1,69 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import sys
+import timeit
+
+from common import create_testbed, create_user
+
+from google.appengine.ext import ndb
+
+from poker.models import Game, Story, Round, Estimate, GameSnapshot
+from poker.records import EstimateRecord
+
+ESTIMATES = 1000
+REPEAT = 20
+
+def get_size(entity):
+    size = sys.getsizeof(entity)
+    for attr in ('__dict__', '_values'):
+        value = getattr(entity, attr, None)
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+def create_game():
+    user = create_user(0)
+    game = Game(name = 'Benchmark', deck = 1, user = user)
+    game.put()
+    game = game.new_story('Story')
+    story = Story.get_by_id(game.current_story_id, parent = game.key)
+    round = story.get_rounds().get()
+    estimates = []
+    for i in range(ESTIMATES):
+        estimates.append(Estimate(
+            key = Round.get_estimate_key(round.key, create_user(i)),
+            user = create_user(i),
+            card = i % len(game.get_deck().cards)
+        ))
+    ndb.put_multi(estimates)
+    round.completed = True
+    round.put()
+    return game, story
+
+def main():
+    bed = create_testbed()
+    try:
+        game, story = create_game()
+        rounds = story.get_rounds().fetch()
+        estimates = {rounds[0].key: rounds[0].get_estimates().fetch()}
+        snapshot = GameSnapshot(game)
+
+        entities = timeit.timeit(lambda: story.get_message(game, rounds, estimates), number = REPEAT)
+        records = timeit.timeit(lambda: snapshot.get_story_messages(), number = REPEAT)
+        build = timeit.timeit(lambda: GameSnapshot(game), number = REPEAT)
+
+        entity_size = sum(get_size(estimate) for estimate in estimates[rounds[0].key])
+        record_size = sum(sys.getsizeof(estimate) for estimate in snapshot.current_story.rounds[0].estimates)
+
+        print('estimates: {}'.format(ESTIMATES))
+        print('entity messages: {:.2f} ms'.format(entities / REPEAT * 1000))
+        print('record messages: {:.2f} ms'.format(records / REPEAT * 1000))
+        print('record snapshot build (with queries): {:.2f} ms'.format(build / REPEAT * 1000))
+        print('entity memory: {} bytes'.format(entity_size))
+        print('record memory: {} bytes ({} slots)'.format(record_size, len(EstimateRecord.__slots__)))
+    finally:
+        bed.deactivate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import argparse
+import urlparse
+
+from common import create_testbed, create_user
+from fake_firebase import FakeFirebase
+
+# poker.firebase reads the database URL at import time, so the fake server
+# has to be listening before the application is imported.
+FIREBASE = FakeFirebase().start()
+os.environ['FIREBASE_DATABASE_URL'] = FIREBASE.get_url()
+
+import webapp2
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from poker.app import application
+from poker.decks import get_deck
+from poker.models import Game, Story, Round
+from poker.profiler import get_profile_stats
+
+DECK = 1
+
+class Session(object):
+
+    def __init__(self, bed):
+        self.bed = bed
+        self.tasks = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def request(self, user, path, params = None, admin = False):
+        self.bed.setup_env(
+            user_email = user.email(),
+            user_id = user.user_id(),
+            user_is_admin = '1' if admin else '0',
+            overwrite = True
+        )
+        # Every App Engine request starts with an empty ndb context cache.
+        ndb.get_context().clear_cache()
+        if params is None:
+            request = webapp2.Request.blank(path)
+        else:
+            request = webapp2.Request.blank(path, POST = params)
+        response = request.get_response(application)
+        if response.status_int >= 400:
+            raise Exception('{} {} responded with {}'.format(request.method, path, response.status))
+        return response
+
+    def run_tasks(self, user):
+        while True:
+            tasks = self.tasks.get_filtered_tasks()
+            if not tasks:
+                return
+            self.tasks.FlushQueue('default')
+            for task in tasks:
+                self.request(user, task.url, dict(urlparse.parse_qsl(task.payload or '')), admin = True)
+
+def create_backlog(game, size):
+    cards = len(game.get_deck().cards)
+    for i in range(size):
+        game = game.new_story('Backlog story {}'.format(i))
+        story = Story.get_by_id(game.current_story_id, parent = game.key)
+        game = story.complete(i % cards)
+    return game
+
+def run(args):
+    session = Session(create_testbed())
+    random.seed(args.seed)
+    owner = create_user(0)
+    players = [owner] + [create_user(i) for i in range(1, args.players)]
+    cards = len(get_deck(DECK).cards)
+
+    response = session.request(owner, '/game', {'name': 'Benchmark', 'deck': str(DECK)})
+    game_url = urlparse.urlparse(response.headers['Location']).path
+    game = Game.get_by_id(int(game_url.rsplit('/', 1)[1]))
+    create_backlog(game, args.backlog)
+
+    for player in players:
+        session.request(player, game_url)
+        session.request(player, game_url + '/opened', {})
+    session.run_tasks(owner)
+
+    for i in range(args.stories):
+        session.request(owner, game_url + '/story', {'name': 'Story {}'.format(i)})
+        game = Game.get_by_id(game.key.id())
+        story = Story.get_by_id(game.current_story_id, parent = game.key)
+        story_url = story.get_url(game)
+        for j in range(args.rounds):
+            if j:
+                session.request(owner, story_url + '/round', {})
+            round = Round.query(ancestor = story.key).order(-Round.created).get()
+            round_url = round.get_url(story, game)
+            for player in players:
+                session.request(player, round_url + '/estimate', {'card': str(random.randrange(cards))})
+                if random.random() < args.reconnects:
+                    session.request(player, game_url + '/opened', {'snapshot': '1'})
+                session.run_tasks(owner)
+        session.request(owner, story_url + '/complete', {'card': str(random.randrange(cards))})
+        session.run_tasks(owner)
+
+def report():
+    print('{:<56} {:>6} {:>24} {:>12} {:>18} {:>18}'.format(
+        'operation', 'count', 'time p50/p90/p99 ms', 'rpcs p50/p99', 'firebase ms p50/p99', 'pushed B p50/p99'))
+    for route, stats in sorted(get_profile_stats().get_stats().items()):
+        print('{:<56} {:>6} {:>24} {:>12} {:>18} {:>18}'.format(
+            route,
+            stats['count'],
+            '{p50:.1f}/{p90:.1f}/{p99:.1f}'.format(**stats['time']),
+            '{p50}/{p99}'.format(**stats['rpcs']),
+            '{p50:.1f}/{p99:.1f}'.format(**stats['firebase_time']),
+            '{p50}/{p99}'.format(**stats['firebase_bytes'])
+        ))
+    print('')
+    print('firebase requests: {}'.format(dict(FIREBASE.requests)))
+    print('firebase bytes received: {}'.format(FIREBASE.bytes))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Drive scripted planning sessions through the application.')
+    parser.add_argument('--players', type = int, default = 8)
+    parser.add_argument('--stories', type = int, default = 10)
+    parser.add_argument('--rounds', type = int, default = 2)
+    parser.add_argument('--backlog', type = int, default = 50, help = 'completed stories in the game before the session')
+    parser.add_argument('--reconnects', type = float, default = 0.1, help = 'chance that a player reconnects after voting')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    try:
+        run(args)
+        report()
+    finally:
+        FIREBASE.stop()
+
+if __name__ == '__main__':
+    main()
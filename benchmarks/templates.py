@@ -0,0 +1,44 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import time
+import shutil
+import tempfile
+
+import common
+
+import jinja2
+
+from poker import templates
+from poker.templates import create_environment, compile_templates
+
+TEMPLATES = ('base.html', 'index.html', 'list.html', 'game.html')
+REPEAT = 20
+
+def load_templates(loader):
+    start = time.time()
+    environment = create_environment(loader)
+    for name in TEMPLATES:
+        environment.get_template(name)
+    return time.time() - start
+
+def measure(create_loader):
+    # A new environment and loader per run has empty template caches, and
+    # ModuleLoader imports the compiled modules under a new package name,
+    # which is what the first request of a fresh instance pays for.
+    return min(load_templates(create_loader()) for i in range(REPEAT))
+
+def main():
+    target = tempfile.mkdtemp()
+    try:
+        compile_templates(target)
+        source = measure(lambda: jinja2.FileSystemLoader(templates.TEMPLATES_PATH))
+        compiled = measure(lambda: jinja2.ModuleLoader(target))
+        print('templates: {}'.format(', '.join(TEMPLATES)))
+        print('cold load from source: {:.2f} ms'.format(source * 1000))
+        print('cold load from compiled modules: {:.2f} ms'.format(compiled * 1000))
+    finally:
+        shutil.rmtree(target)
+
+if __name__ == '__main__':
+    main()
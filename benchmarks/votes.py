@@ -0,0 +1,96 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import time
+import argparse
+import threading
+from collections import Counter
+
+from common import create_testbed, create_user
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+from poker.models import Game, Participant, Story, Round, Vote
+
+CALLS = Counter()
+CALLS_LOCK = threading.Lock()
+
+def count_call(service, call, request, response):
+    if service == 'datastore_v3':
+        with CALLS_LOCK:
+            CALLS[call] += 1
+
+def create_game(players):
+    owner = create_user(0)
+    game = Game(name = 'Stress', deck = 1, user = owner, stories = 0)
+    game.put()
+    ndb.put_multi([
+        Participant(id = str(game.key.id()) + create_user(i).user_id(), parent = game.key, user = create_user(i))
+        for i in range(players)
+    ])
+    game.update_players()
+    game = game.new_story('Stress story')
+    story = Story.get_by_id(game.current_story_id, parent = game.key)
+    round = story.get_rounds().get()
+    return game, round
+
+def vote(game, round, users, start, results, errors):
+    start.wait()
+    for user in users:
+        try:
+            results.append(round.add_vote(user, int(user.user_id()) % len(game.get_deck().cards), game).completed)
+        except Exception as e:
+            errors.append(e)
+
+def run(players, threads, repeat):
+    game, round = create_game(players)
+    users = [create_user(i) for i in range(players)] * repeat
+    start = threading.Event()
+    results = []
+    errors = []
+    workers = [
+        threading.Thread(target = vote, args = (game, round, users[i::threads], start, results, errors))
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    CALLS.clear()
+    began = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - began
+    round = round.key.get()
+    estimates = round.get_estimates().fetch()
+    # Votes are deleted once they are folded into estimates.
+    leftover = Vote.query(Vote.game == game.key).count()
+    # Every distinct voter costs one transaction on their own vote. Anything
+    # above that is a completion attempt on the round or a retry.
+    extra = CALLS['BeginTransaction'] - players
+    print('players: {}, threads: {}, votes posted: {}'.format(players, threads, len(users)))
+    print('elapsed: {:.1f} ms'.format(elapsed * 1000))
+    print('errors: {}'.format(len(errors)))
+    print('round completed: {}, completions seen: {}'.format(round.completed, sum(results)))
+    print('votes left over: {}, estimates folded: {}'.format(leftover, len(estimates)))
+    print('transactions: {}, commits: {}, beyond one per voter: {}'.format(CALLS['BeginTransaction'], CALLS['Commit'], extra))
+    ok = not errors and round.completed and leftover == 0 and len(estimates) == players and round.votes == players
+    print('consistent: {}'.format(ok))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Post concurrent votes for one round and check the result.')
+    parser.add_argument('--players', type = int, default = 100)
+    parser.add_argument('--threads', type = int, default = 100)
+    parser.add_argument('--repeat', type = int, default = 2, help = 'times every player posts the same vote')
+    args = parser.parse_args()
+    bed = create_testbed()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('votes-benchmark', count_call)
+    try:
+        ok = run(args.players, args.threads, args.repeat)
+    finally:
+        bed.deactivate()
+    raise SystemExit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
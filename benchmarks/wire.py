@@ -0,0 +1,96 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import json
+import argparse
+import subprocess
+
+from common import ROOT, create_testbed, create_user
+
+from google.appengine.ext import ndb
+
+from poker.models import Game, Participant, Story
+from poker.wire import LEGACY_FORMAT, COMPACT_FORMAT, encode_message
+
+SCRIPT_PATH = os.path.join(ROOT, 'assets', 'js', 'poker-1.2.0.js')
+
+# Loads the client script with just enough of jQuery to reach its decoder.
+DECODE_SCRIPT = '''
+global.window = {};
+global.jQuery = function() { return {on: function() {}}; };
+jQuery.fn = {};
+require(process.argv[1]);
+var input = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+var poker = {gameUrl: input.url, deck: input.deck};
+var game = jQuery.fn.poker.Constructor.prototype.decode.call(poker, input.message);
+process.stdout.write(JSON.stringify(game));
+'''
+
+def create_game(stories, players, rounds):
+    owner = create_user(0)
+    game = Game(name = 'Wire format', deck = 1, user = owner, stories = 0)
+    game.put()
+    users = [create_user(i) for i in range(players)]
+    ndb.put_multi([
+        Participant(id = str(game.key.id()) + user.user_id(), parent = game.key, user = user)
+        for user in users
+    ])
+    game.update_players()
+    cards = len(game.get_deck().cards)
+    for i in range(stories):
+        game = game.new_story('https://tracker.example.com/browse/POKER-{} Story {}'.format(1000 + i, i))
+        story = Story.get_by_id(game.current_story_id, parent = game.key)
+        for j in range(rounds):
+            round = story.get_rounds().get() if j == 0 else story.new_round(game)
+            for user in users:
+                round.add_vote(user, (i + j + int(user.user_id())) % cards, game)
+        if i < stories - 1:
+            game = story.complete(i % cards, game)
+    return game
+
+def get_sizes(message):
+    content = json.dumps(message, separators = (',', ':'))
+    return len(content), len(zlib.compress(content))
+
+def check_round_trip(message):
+    # The client decodes the compact snapshot back into the legacy message.
+    expected = json.loads(json.dumps(encode_message(message, LEGACY_FORMAT)))
+    process = subprocess.Popen(['node', '-e', DECODE_SCRIPT, SCRIPT_PATH], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+    output, _ = process.communicate(json.dumps({
+        'url': message['url'],
+        'deck': expected['deck'],
+        'message': encode_message(message, COMPACT_FORMAT),
+    }))
+    if process.returncode:
+        return False
+    return json.loads(output) == expected
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compare snapshot sizes in the legacy and compact wire formats.')
+    parser.add_argument('--stories', type = int, default = 100)
+    parser.add_argument('--players', type = int, default = 10)
+    parser.add_argument('--rounds', type = int, default = 3)
+    args = parser.parse_args()
+    bed = create_testbed()
+    try:
+        game = create_game(args.stories, args.players, args.rounds)
+        message = game.get_message()
+        legacy = get_sizes(encode_message(message, LEGACY_FORMAT))
+        compact = get_sizes(encode_message(message, COMPACT_FORMAT))
+        print('stories: {}, players: {}, rounds in current story: {}'.format(args.stories, args.players, args.rounds))
+        print('legacy: {} bytes ({} compressed)'.format(*legacy))
+        print('compact: {} bytes ({} compressed)'.format(*compact))
+        print('reduction: {:.1f}% ({:.1f}% compressed)'.format(
+            100.0 * (legacy[0] - compact[0]) / legacy[0],
+            100.0 * (legacy[1] - compact[1]) / legacy[1]
+        ))
+        ok = check_round_trip(message)
+        print('round trip through the client decoder: {}'.format('ok' if ok else 'MISMATCH'))
+    finally:
+        bed.deactivate()
+    raise SystemExit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import os
+import imp
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+
+# The jinja2 bundled with the SDK is the one App Engine runs.
+if os.environ.get('GAE_SDK'):
+    sys.path.insert(0, os.path.join(os.environ['GAE_SDK'], 'lib', 'jinja2-2.6'))
+
+# Importing the poker package would import the App Engine application, so the
+# template settings are loaded straight from their module.
+templates = imp.load_source('poker_templates', os.path.join(ROOT, 'poker', 'templates.py'))
+
+if __name__ == '__main__':
+    version = templates.jinja2.__version__
+    if version != templates.JINJA2_VERSION:
+        sys.exit('Found jinja2 {} but App Engine runs {}; set GAE_SDK or install jinja2=={}'.format(
+            version, templates.JINJA2_VERSION, templates.JINJA2_VERSION))
+    templates.compile_templates()
+    print('Compiled templates into {}'.format(os.path.normpath(templates.COMPILED_TEMPLATES_PATH)))
@@ -4,16 +4,21 @@
 import webapp2
 
 from poker.handlers import *
+from poker.profiler import ProfilerMiddleware
 
 application = webapp2.WSGIApplication([
     ('/', MainPage),
     ('/game', NewGame),
+    ('/deck', NewDeck),
     ('/game/list', GameList),
+    ('/game/export\.(csv|ndjson)', ExportGames),
     ('/game/(\d+)', GamePage),
     ('/game/(\d+)/opened', GameOpened),
     ('/game/(\d+)/closed', GameClosed),
+    ('/game/(\d+)/presence', GamePresence),
     ('/game/(\d+)/(complete|reopen)', ToggleCompleteGame),
     ('/game/(\d+)/delete', DeleteGame),
+    ('/game/(\d+)/export\.(csv|ndjson)', ExportGame),
     ('/game/(\d+)/story', NewStory),
     ('/game/(\d+)/story/(\d+)/skip', SkipStory),
     ('/game/(\d+)/story/(\d+)/complete', CompleteStory),
@@ -21,5 +26,13 @@ application = webapp2.WSGIApplication([
     ('/game/(\d+)/story/(\d+)/round/(\d+)/complete', CompleteRound),
     ('/game/(\d+)/story/(\d+)/round/(\d+)/estimate', EstimateRound),
     ('/game/(\d+)/participant/(\d+)/(player|observer)', ToggleGameObserver),
-    ('/game/(\d+)/participant/(\d+)/delete', DeleteParticipant)
+    ('/game/(\d+)/participant/(\d+)/delete', DeleteParticipant),
+    ('/tasks/game/summary', UpdateGameSummaries),
+    ('/tasks/game/(\d+)/update', UpdateGame),
+    ('/tasks/game/(\d+)/delete', PurgeGame),
+    ('/tasks/game/(\d+)/archive', ArchiveGame),
+    ('/tasks/game/(\d+)/restore', RestoreGame),
+    ('/admin/stats', ProfileStatsPage)
 ], debug = True)
+
+application = ProfilerMiddleware(application)
@@ -0,0 +1,165 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+try:
+    from functools import lru_cache
+except ImportError:
+    from functools32 import lru_cache
+import time
+import threading
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+__all__ = [
+    'LocalCache',
+    'SnapshotCache',
+    'PresenceCache',
+    'VoteTally',
+    'get_snapshot_cache',
+    'get_presence_cache',
+    'get_vote_tally',
+]
+
+class LocalCache(object):
+
+    def __init__(self, size = 100):
+        self.size = size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.pop(key, None)
+            if value is not None:
+                self.values[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = value
+            while len(self.values) > self.size:
+                self.values.popitem(last = False)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+class SnapshotCache(object):
+
+    def __init__(self, size = 100):
+        self.local = LocalCache(size)
+        self.lock = threading.Lock()
+        self.stats = {
+            'local_hits': 0,
+            'memcache_hits': 0,
+            'misses': 0,
+        }
+
+    def get_key(self, game_id, version):
+        return 'snapshot:{}:{}'.format(game_id, version)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, game_id, version, local = True):
+        key = self.get_key(game_id, version)
+        if local:
+            message = self.local.get(key)
+            if message is not None:
+                self.count('local_hits')
+                return message
+        message = memcache.get(key)
+        if message is None:
+            self.count('misses')
+            return None
+        self.count('memcache_hits')
+        self.local.set(key, message)
+        return message
+
+    def set(self, game_id, version, message):
+        key = self.get_key(game_id, version)
+        self.local.set(key, message)
+        memcache.set(key, message)
+
+    def delete(self, game_id, version):
+        key = self.get_key(game_id, version)
+        self.local.delete(key)
+        memcache.delete(key)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        requests = sum(stats.values())
+        hits = stats['local_hits'] + stats['memcache_hits']
+        stats['hit_rate'] = float(hits) / requests if requests else 0.0
+        return stats
+
+@lru_cache()
+def get_snapshot_cache():
+    return SnapshotCache()
+
+class PresenceCache(object):
+    TIMEOUT = 15 * 60
+    RETRIES = 10
+
+    def get_key(self, game_id):
+        return 'presence:{}'.format(game_id)
+
+    def get(self, game_id):
+        channels = memcache.get(self.get_key(game_id))
+        if channels is None:
+            return None
+        expired = time.time() - self.TIMEOUT
+        return set(channel_id for channel_id, seen in channels.items() if seen > expired)
+
+    def update(self, game_id, channel_id, online):
+        key = self.get_key(game_id)
+        client = memcache.Client()
+        for i in range(self.RETRIES):
+            channels = client.gets(key)
+            now = time.time()
+            if channels is None:
+                channels = {channel_id: now} if online else {}
+                if client.add(key, channels, time = self.TIMEOUT):
+                    return True
+                continue
+            channels = dict((other, seen) for other, seen in channels.items() if seen > now - self.TIMEOUT)
+            if online:
+                channels[channel_id] = now
+            else:
+                channels.pop(channel_id, None)
+            if client.cas(key, channels, time = self.TIMEOUT):
+                return True
+        return False
+
+    def set_online(self, game_id, channel_id):
+        return self.update(game_id, channel_id, True)
+
+    def set_offline(self, game_id, channel_id):
+        return self.update(game_id, channel_id, False)
+
+@lru_cache()
+def get_presence_cache():
+    return PresenceCache()
+
+class VoteTally(object):
+    TIMEOUT = 24 * 60 * 60
+
+    def get_key(self, round_id):
+        return 'votes:{}'.format(round_id)
+
+    def start(self, round_id, count = 0):
+        return memcache.add(self.get_key(round_id), count, time = self.TIMEOUT)
+
+    def get(self, round_id):
+        return memcache.get(self.get_key(round_id))
+
+    def incr(self, round_id):
+        return memcache.incr(self.get_key(round_id))
+
+@lru_cache()
+def get_vote_tally():
+    return VoteTally()
@@ -0,0 +1,106 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+import math
+
+from google.appengine.ext import ndb
+
+from poker.cache import LocalCache
+
+__all__ = [
+    'Deck',
+    'CustomDeck',
+    'get_deck',
+    'get_decks',
+]
+
+def get_value(label):
+    try:
+        if '/' in label:
+            numerator, denominator = label.split('/', 1)
+            value = int(numerator) / int(denominator)
+        else:
+            value = float(label)
+    except (ValueError, ZeroDivisionError):
+        return None
+    # Labels such as 'inf' or 'nan' parse, but could not be written as JSON.
+    if math.isinf(value) or math.isnan(value):
+        return None
+    return value
+
+class Deck(object):
+
+    def __init__(self, id, cards, name = None):
+        self.id = id
+        self.name = name
+        self.cards = tuple(cards)
+        self.indexes = dict((card, index) for index, card in enumerate(self.cards))
+        self.values = tuple(get_value(card) for card in self.cards)
+
+    def has_card(self, index):
+        return 0 <= index < len(self.cards)
+
+    def get_card(self, index):
+        if not self.has_card(index):
+            return None
+        return self.cards[index]
+
+    def get_index(self, card):
+        return self.indexes.get(card)
+
+    def get_value(self, index):
+        if not self.has_card(index):
+            return None
+        return self.values[index]
+
+class CustomDeck(ndb.Model):
+    name = ndb.StringProperty(required = True)
+    cards = ndb.StringProperty(repeated = True)
+    user = ndb.UserProperty(required = True)
+    created = ndb.DateTimeProperty(auto_now_add = True)
+
+    def get_deck(self):
+        return Deck(self.key.id() + CUSTOM_DECK_OFFSET, self.cards, self.name)
+
+DECKS = (
+    Deck(1, ('1', '2', '3', '5', '8', '13', '21', '100', '?', 'Coffee')),
+    Deck(2, ('0', '1/2' , '1', '2', '3', '5', '8', '13', '20', '40', '60', '100', '?', 'oo')),
+    Deck(3, ('0', '1', '2', '3', '5', '8', '13', '21', '44', '?', 'oo')),
+)
+
+EMPTY_DECK = Deck(None, ())
+
+# Custom decks are numbered above the built-in ones, so that their entity ids
+# can never shadow or be shadowed by a built-in deck.
+CUSTOM_DECK_OFFSET = 1000
+
+DECK_REGISTRY = dict((deck.id, deck) for deck in DECKS)
+
+CUSTOM_DECKS = LocalCache(1000)
+
+def get_deck(deck_id):
+    deck = DECK_REGISTRY.get(deck_id)
+    if deck:
+        return deck
+    if not deck_id or deck_id <= CUSTOM_DECK_OFFSET:
+        return EMPTY_DECK
+    deck = CUSTOM_DECKS.get(deck_id)
+    if deck:
+        return deck
+    custom_deck = CustomDeck.get_by_id(deck_id - CUSTOM_DECK_OFFSET)
+    if not custom_deck:
+        return EMPTY_DECK
+    deck = custom_deck.get_deck()
+    CUSTOM_DECKS.set(deck_id, deck)
+    return deck
+
+def get_decks(user = None):
+    decks = list(DECKS)
+    if user:
+        for custom_deck in CustomDeck.query(CustomDeck.user == user).order(CustomDeck.created):
+            deck = custom_deck.get_deck()
+            CUSTOM_DECKS.set(deck.id, deck)
+            decks.append(deck)
+    return decks
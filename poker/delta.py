@@ -0,0 +1,31 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+__all__ = [
+    'get_updates',
+]
+
+def get_path(path, key):
+    if path:
+        return '{}/{}'.format(path, key)
+    return str(key)
+
+def add_updates(updates, path, previous, current):
+    if previous == current:
+        return
+    if isinstance(previous, dict) and isinstance(current, dict):
+        for key in set(previous) | set(current):
+            add_updates(updates, get_path(path, key), previous.get(key), current.get(key))
+    elif isinstance(previous, list) and isinstance(current, list) and len(previous) <= len(current):
+        for index, value in enumerate(current):
+            if index < len(previous):
+                add_updates(updates, get_path(path, index), previous[index], value)
+            else:
+                updates[get_path(path, index)] = value
+    else:
+        updates[path] = current
+
+def get_updates(previous, current):
+    updates = {}
+    add_updates(updates, '', previous, current)
+    return updates
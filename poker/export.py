@@ -0,0 +1,116 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+
+from poker.models import Game, Story, Round, Estimate
+
+__all__ = [
+    'EXPORT_FIELDS',
+    'get_game_rows',
+    'get_user_rows',
+    'write_csv',
+    'write_ndjson',
+]
+
+EXPORT_CHUNK = 200
+
+EXPORT_FIELDS = (
+    'game',
+    'game_name',
+    'story',
+    'story_name',
+    'story_estimate',
+    'round',
+    'round_completed',
+    'user',
+    'user_name',
+    'card',
+)
+
+def iterate(query, chunk = EXPORT_CHUNK):
+    cursor = None
+    more = True
+    while more:
+        entities, cursor, more = query.fetch_page(chunk, start_cursor = cursor, use_cache = False, use_memcache = False)
+        for entity in entities:
+            yield entity
+
+def iterate_children(entities, parent_key):
+    # Children come in key order, so they are grouped under their parent and
+    # the groups follow the parents' own key order.
+    while entities[0] is not None and entities[0].key.parent().pairs() < parent_key.pairs():
+        entities[0] = next(entities[1], None)
+    while entities[0] is not None and entities[0].key.parent() == parent_key:
+        yield entities[0]
+        entities[0] = next(entities[1], None)
+
+def get_story_estimate(deck, story):
+    if story.estimate == Story.SKIPPED:
+        return 'skipped'
+    if story.estimate is None:
+        return None
+    return deck.get_card(story.estimate)
+
+def iterate_archive(archive, kind):
+    return iter(sorted(archive.get_entities(kind), key = lambda entity: entity.key.pairs()))
+
+def get_game_rows(game):
+    deck = game.get_deck()
+    archive = game.get_archive()
+    if archive is not None:
+        stories = iterate_archive(archive, Story)
+        rounds = iterate_archive(archive, Round)
+        estimates = iterate_archive(archive, Estimate)
+    else:
+        stories = iterate(Story.query(ancestor = game.key).order(Story.key))
+        rounds = iterate(Round.query(ancestor = game.key).order(Round.key))
+        estimates = iterate(Estimate.query(ancestor = game.key).order(Estimate.key))
+    rounds = [next(rounds, None), rounds]
+    estimates = [next(estimates, None), estimates]
+    for story in stories:
+        row = {
+            'game': game.key.id(),
+            'game_name': game.name,
+            'story': story.key.id(),
+            'story_name': story.name,
+            'story_estimate': get_story_estimate(deck, story),
+        }
+        found = False
+        for round in iterate_children(rounds, story.key):
+            row['round'] = round.key.id()
+            row['round_completed'] = round.completed
+            for estimate in iterate_children(estimates, round.key):
+                found = True
+                row['user'] = estimate.user.user_id()
+                row['user_name'] = estimate.user.nickname()
+                row['card'] = deck.get_card(estimate.card) if round.completed else None
+                yield dict(row)
+        if not found:
+            yield dict(row)
+
+def get_user_rows(user):
+    for game in iterate(Game.query(Game.user == user).order(-Game.created)):
+        if game.deleting:
+            continue
+        for row in get_game_rows(game):
+            yield row
+
+def encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def write_csv(rows, out):
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow([encode(row.get(field)) for field in EXPORT_FIELDS])
+
+def write_ndjson(rows, out):
+    for row in rows:
+        out.write(json.dumps(row))
+        out.write('\n')
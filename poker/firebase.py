@@ -1,6 +1,7 @@
 #!/usr/bin/python2.7
 # -*- coding: utf-8 -*-
 
+import os
 import base64
 try:
     from functools import lru_cache
@@ -8,12 +9,18 @@ except ImportError:
     from functools32 import lru_cache
 import json
 import time
-import httplib2
+import hashlib
+import threading
 
 from google.appengine.api import app_identity
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
 from oauth2client.client import GoogleCredentials
 
-FIREBASE_DATABASE_URL = 'https://poker-planning-a8ba9.firebaseio.com'
+from poker.cache import LocalCache
+from poker.profiler import get_profile
+
+FIREBASE_DATABASE_URL = os.environ.get('FIREBASE_DATABASE_URL', 'https://poker-planning-a8ba9.firebaseio.com')
 
 IDENTITY_ENDPOINT = ('https://identitytoolkit.googleapis.com/google.identity.identitytoolkit.v1.IdentityToolkit')
 
@@ -22,22 +29,189 @@ FIREBASE_SCOPES = [
     'https://www.googleapis.com/auth/userinfo.email',
 ]
 
+MAX_REQUESTS = 10
+
+FIREBASE_DEADLINE = 10
+
+TOKEN_REFRESH_MINUTES = 10
+
+TOKEN_HEADER = base64.b64encode(json.dumps({'typ': 'JWT', 'alg': 'RS256'}))
+
+class FirebaseError(Exception):
+
+    def __init__(self, status, content):
+        super(FirebaseError, self).__init__('Firebase responded with {}: {}'.format(status, content))
+        self.status = status
+        self.content = content
+
 @lru_cache()
-def get_http():
-    http = httplib2.Http()
-    creds = GoogleCredentials.get_application_default().create_scoped(FIREBASE_SCOPES)
-    creds.authorize(http)
-    return http
+def get_credentials():
+    return GoogleCredentials.get_application_default().create_scoped(FIREBASE_SCOPES)
+
+def get_firebase_headers():
+    # A local fake Firebase server is plain HTTP and needs no credentials.
+    if not FIREBASE_DATABASE_URL.startswith('https://'):
+        return {}
+    return {'Authorization': 'Bearer {}'.format(get_credentials().get_access_token().access_token)}
+
+class FirebaseResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+
+class FirebaseRpc(object):
+
+    def __init__(self, path, method, body=None):
+        self.path = path
+        self.method = method
+        self.size = len(body or '')
+        self.profile = get_profile()
+        self.start = time.time()
+        self.result = None
+        self.rpc = urlfetch.create_rpc(deadline=FIREBASE_DEADLINE)
+        url = '{}/{}.json'.format(FIREBASE_DATABASE_URL, path)
+        urlfetch.make_fetch_call(self.rpc, url, payload=body, method=method, headers=get_firebase_headers())
+
+    def get_result(self):
+        if self.result is None:
+            status = None
+            try:
+                result = self.rpc.get_result()
+                status = result.status_code
+                self.result = (FirebaseResponse(status), result.content)
+            finally:
+                if self.profile is not None:
+                    self.profile.add_firebase(self.method, self.path, status, time.time() - self.start, self.size)
+        return self.result
+
+def request_firebase(path, method, body=None):
+    return FirebaseRpc(path, method, body)
+
+def send_firebase_request(path, method, body=None):
+    return request_firebase(path, method, body).get_result()
+
+def request_firebase_message(uid, message=None):
+    path = 'channels/{}'.format(uid)
+    if message:
+        return request_firebase(path, 'PATCH', message)
+    else:
+        return request_firebase(path, 'DELETE')
 
 def send_firebase_message(uid, message=None):
-    url = '{}/channels/{}.json'.format(FIREBASE_DATABASE_URL, uid)
+    return request_firebase_message(uid, message).get_result()
+
+def request_game_message(game_id, message=None):
+    path = 'games/{}'.format(game_id)
     if message:
-        return get_http().request(url, 'PATCH', body=message)
+        return request_firebase(path, 'PUT', message)
     else:
-        return get_http().request(url, 'DELETE')
+        return request_firebase(path, 'DELETE')
+
+def send_game_message(game_id, message=None):
+    return request_game_message(game_id, message).get_result()
+
+def request_game_updates(game_id, updates):
+    path = 'games/{}'.format(game_id)
+    return request_firebase(path, 'PATCH', updates)
+
+def send_game_updates(game_id, updates):
+    return request_game_updates(game_id, updates).get_result()
+
+def send_firebase_messages(messages, max_requests=MAX_REQUESTS):
+    errors = {}
+    pending = list(messages.items())
+    rpcs = []
+    while pending or rpcs:
+        while pending and len(rpcs) < max_requests:
+            uid, message = pending.pop()
+            try:
+                rpcs.append((uid, request_firebase_message(uid, message)))
+            except Exception as e:
+                errors[uid] = e
+        if not rpcs:
+            continue
+        uid, rpc = rpcs.pop(0)
+        try:
+            response, content = rpc.get_result()
+            if response.status >= 400:
+                errors[uid] = FirebaseError(response.status, content)
+            else:
+                errors[uid] = None
+        except Exception as e:
+            errors[uid] = e
+    return errors
+
+class TokenCache(object):
+
+    def __init__(self, size=1000):
+        self.local = LocalCache(size)
+        self.lock = threading.Lock()
+        self.stats = {
+            'local_hits': 0,
+            'memcache_hits': 0,
+            'misses': 0,
+            'sign_time': 0.0,
+        }
+
+    def get_key(self, uid, valid_minutes, claims):
+        # Tokens are only interchangeable when they carry the same claims.
+        digest = hashlib.sha1(json.dumps([valid_minutes, claims], sort_keys=True)).hexdigest()
+        return 'token:{}:{}'.format(uid, digest)
+
+    def count(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
+
+    def get(self, uid, valid_minutes=60, claims=None):
+        key = self.get_key(uid, valid_minutes, claims)
+        refresh = time.time() + TOKEN_REFRESH_MINUTES * 60
+        cached = self.local.get(key)
+        if cached and cached[1] > refresh:
+            self.count('local_hits')
+            return cached[0]
+        cached = memcache.get(key)
+        if cached and cached[1] > refresh:
+            self.count('memcache_hits')
+            self.local.set(key, cached)
+            return cached[0]
+        self.count('misses')
+        return None
+
+    def set(self, uid, token, expires, valid_minutes=60, claims=None):
+        key = self.get_key(uid, valid_minutes, claims)
+        self.local.set(key, (token, expires))
+        memcache.set(key, (token, expires), time=int(expires - time.time()))
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        hits = stats['local_hits'] + stats['memcache_hits']
+        requests = hits + stats['misses']
+        stats['hit_rate'] = float(hits) / requests if requests else 0.0
+        stats['sign_time_average'] = stats['sign_time'] / stats['misses'] if stats['misses'] else 0.0
+        return stats
+
+@lru_cache()
+def get_token_cache():
+    return TokenCache()
+
+@lru_cache()
+def get_service_account_name():
+    return app_identity.get_service_account_name()
+
+def create_custom_token(uid, valid_minutes=60, claims=None):
+    cache = get_token_cache()
+    token = cache.get(uid, valid_minutes, claims)
+    if token:
+        return token
+    start = time.time()
+    token, expires = sign_custom_token(uid, valid_minutes, claims)
+    cache.count('sign_time', time.time() - start)
+    cache.set(uid, token, expires, valid_minutes, claims)
+    return token
 
-def create_custom_token(uid, valid_minutes=60):
-    client_email = app_identity.get_service_account_name()
+def sign_custom_token(uid, valid_minutes=60, claims=None):
+    client_email = get_service_account_name()
     now = int(time.time())
     body = {
         'iss': client_email,
@@ -47,7 +221,9 @@ def create_custom_token(uid, valid_minutes=60):
         'iat': now,
         'exp': now + (valid_minutes * 60),
     }
+    if claims:
+        body['claims'] = claims
     payload = base64.b64encode(json.dumps(body))
-    header = base64.b64encode(json.dumps({'typ': 'JWT', 'alg': 'RS256'}))
-    to_sign = '{}.{}'.format(header, payload)
-    return '{}.{}'.format(to_sign, base64.b64encode(app_identity.sign_blob(to_sign)[1]))
+    to_sign = '{}.{}'.format(TOKEN_HEADER, payload)
+    token = '{}.{}'.format(to_sign, base64.b64encode(app_identity.sign_blob(to_sign)[1]))
+    return token, body['exp']
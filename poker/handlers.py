@@ -1,30 +1,34 @@
 #!/usr/bin/python2.7
 # -*- coding: utf-8 -*-
 
-import os
 import datetime
+import time
 import json
 import webapp2
-import jinja2
-import urllib
 
 from google.appengine.api import users
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
 from poker.models import *
-from poker.firebase import create_custom_token, send_firebase_message
+from poker.decks import CustomDeck, get_deck, get_decks
+from poker.firebase import create_custom_token, send_firebase_message, get_token_cache
+from poker.identity import IdentityMap
+from poker.profiler import get_profile, get_profile_stats
+from poker.cache import get_snapshot_cache, get_presence_cache
+from poker.export import get_game_rows, get_user_rows, write_csv, write_ndjson
+from poker.templates import create_environment, create_loader
+from poker.wire import COMPACT_FORMAT, LEGACY_FORMAT, encode_message, set_client_format, get_wire_format, get_published
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader = jinja2.FileSystemLoader(os.path.join(os.path.dirname(__file__), '../templates')),
-    extensions = [
-        'jinja2.ext.autoescape',
-    ],
-    autoescape = True
-)
+JINJA_ENVIRONMENT = create_environment(create_loader())
 
 __all__ = [
     'MainPage',
     'NewGame',
+    'NewDeck',
     'GameList',
+    'ExportGames',
+    'ExportGame',
     'DeleteGame',
     'GamePage',
     'GameOpened',
@@ -38,6 +42,13 @@ __all__ = [
     'ToggleGameObserver',
     'DeleteParticipant',
     'GameClosed',
+    'GamePresence',
+    'UpdateGame',
+    'PurgeGame',
+    'ArchiveGame',
+    'RestoreGame',
+    'UpdateGameSummaries',
+    'ProfileStatsPage',
 ]
 
 class Player():
@@ -58,7 +69,7 @@ class Player():
         return users.create_login_url(dest_url)
 
     def get_games(self):
-        return Game.all().filter("user =", self.user)
+        return Game.query(Game.user == self.user)
 
     def get_profile(self):
         return None
@@ -77,11 +88,35 @@ class Player():
 
 class PokerRequestHandler(webapp2.RequestHandler):
     player = None
+    identity_map = None
+
+    def dispatch(self):
+        profile = get_profile()
+        if profile is not None and self.request.route:
+            profile.route = self.request.route.template
+        return super(PokerRequestHandler, self).dispatch()
 
     def get_player(self):
         if self.player is None:
-            player = Player()
-        return player
+            self.player = Player()
+        return self.player
+
+    def get_identity_map(self):
+        if self.identity_map is None:
+            self.identity_map = IdentityMap()
+        return self.identity_map
+
+    def get_parent(self, entity):
+        return self.get_identity_map().get_parent(entity)
+
+    def render_template(self, name, values):
+        start = time.time()
+        template = JINJA_ENVIRONMENT.get_template(name)
+        content = template.render(values)
+        profile = get_profile()
+        if profile is not None:
+            profile.add_render(time.time() - start)
+        self.response.write(content)
 
     def get_user(self, abort = True):
         user = self.get_player().get_user()
@@ -90,9 +125,11 @@ class PokerRequestHandler(webapp2.RequestHandler):
                 self.abort(401)
         return user
 
-    def get_game(self, game_id, check_user = False):
-        game = Game.get_by_id(int(game_id))
-        if not game:
+    def get_game_key(self, game_id):
+        return ndb.Key(Game, int(game_id))
+
+    def check_game(self, game, check_user = False):
+        if not game or game.deleting:
             self.abort(404)
         if check_user:
             user = self.get_player().get_user()
@@ -100,27 +137,54 @@ class PokerRequestHandler(webapp2.RequestHandler):
                 self.abort(403)
         return game
 
+    def get_game(self, game_id, check_user = False):
+        game = self.get_identity_map().get(self.get_game_key(game_id))
+        return self.check_game(game, check_user)
+
     def get_story(self, game_id, story_id, check_user = False):
-        game = self.get_game(game_id, check_user)
-        story = Story.get_by_id(int(story_id), game)
+        game_key = self.get_game_key(game_id)
+        story_key = ndb.Key(Story, int(story_id), parent = game_key)
+        game, story = self.get_identity_map().get_multi([game_key, story_key])
+        self.check_game(game, check_user)
         if not story:
             self.abort(404)
         return story
 
     def get_round(self, game_id, story_id, round_id, check_user = False):
-        story = self.get_story(game_id, story_id, check_user)
-        round = Round.get_by_id(int(round_id), story)
-        if not round:
+        game_key = self.get_game_key(game_id)
+        story_key = ndb.Key(Story, int(story_id), parent = game_key)
+        round_key = ndb.Key(Round, int(round_id), parent = story_key)
+        game, story, round = self.get_identity_map().get_multi([game_key, story_key, round_key])
+        self.check_game(game, check_user)
+        if not story or not round:
             self.abort(404)
         return round
 
     def get_participant(self, game_id, participant_key, check_user = False):
-        game = self.get_game(game_id, check_user)
-        participant = Participant.get_by_key_name(str(participant_key), game)
+        game_key = self.get_game_key(game_id)
+        participant_key = ndb.Key(Participant, str(participant_key), parent = game_key)
+        game, participant = self.get_identity_map().get_multi([game_key, participant_key])
+        self.check_game(game, check_user)
         if not participant:
             self.abort(404)
         return participant
 
+    def get_format(self):
+        try:
+            return int(self.request.get('format', LEGACY_FORMAT))
+        except ValueError:
+            return LEGACY_FORMAT
+
+    def write_export(self, rows, filename, format):
+        if format == 'csv':
+            self.response.content_type = 'text/csv'
+            write = write_csv
+        else:
+            self.response.content_type = 'application/x-ndjson'
+            write = write_ndjson
+        self.response.headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, format)
+        write(rows, self.response.out)
+
 class MainPage(PokerRequestHandler):
     def get(self):
         player = self.get_player()
@@ -128,50 +192,118 @@ class MainPage(PokerRequestHandler):
         if user:
             return self.redirect('/game/list')
         url = player.get_url(self.request.uri)
-        template = JINJA_ENVIRONMENT.get_template('index.html')
-        self.response.write(template.render({
+        self.render_template('index.html', {
             'user': user,
             'url': url,
             'now': datetime.datetime.now(),
-        }))
+        })
 
 class NewGame(PokerRequestHandler):
     def post(self):
         user = self.get_user()
+        name = self.request.get('name')
+        if not name:
+            return self.redirect('/')
+        try:
+            deck = get_deck(int(self.request.get('deck')))
+        except ValueError:
+            return self.redirect('/')
+        if not deck.cards:
+            return self.redirect('/')
         try:
             game = Game(
-                name = self.request.get('name'),
-                deck = int(self.request.get('deck')),
-                user = user
+                name = name,
+                deck = deck.id,
+                user = user,
+                stories = 0
             )
+            game.put()
         except:
             return self.redirect('/')
-        game.put()
         game_url = game.get_url()
         return self.redirect(game_url)
 
+class NewDeck(PokerRequestHandler):
+    def post(self):
+        user = self.get_user()
+        name = self.request.get('name')
+        cards = [card.strip() for card in self.request.get('cards').split(',') if card.strip()]
+        if not name or not cards:
+            self.abort(400)
+        custom_deck = CustomDeck(
+            name = name,
+            cards = cards,
+            user = user
+        )
+        custom_deck.put()
+        return self.redirect('/game/list')
+
 class GameList(PokerRequestHandler):
+    PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+
+    def get_page_size(self):
+        try:
+            size = int(self.request.get('size', self.PAGE_SIZE))
+        except ValueError:
+            self.abort(400)
+        return max(1, min(size, self.MAX_PAGE_SIZE))
+
+    def get_cursor(self):
+        cursor = self.request.get('cursor')
+        if not cursor:
+            return None
+        try:
+            return Cursor(urlsafe = cursor)
+        except Exception:
+            self.abort(400)
 
     def get(self):
         player = self.get_player()
         user = player.get_user()
         url = player.get_url(self.request.uri)
-        games = player.get_games().order("-created")
-        template = JINJA_ENVIRONMENT.get_template('list.html')
-        self.response.write(template.render({
+        size = self.get_page_size()
+        cursor = self.get_cursor()
+        try:
+            start = max(0, int(self.request.get('start', 0)))
+        except ValueError:
+            start = 0
+        games, next_cursor, more = player.get_games().order(-Game.created).fetch_page(
+            size,
+            start_cursor = cursor,
+            projection = Game.LIST_PROJECTION
+        )
+        deleting = set(player.get_games().filter(Game.deleting == True).fetch(keys_only = True))
+        games = [game for game in games if game.key not in deleting]
+        self.render_template('list.html', {
             'user': user,
             'player_name': player.get_name(),
             'player_photo': player.get_photo(),
             'url': url,
             'games': games,
-            'decks': Game.DECK_CHOICES,
+            'start': start,
+            'size': size,
+            'next_cursor': next_cursor.urlsafe() if more and next_cursor else None,
+            'next_start': start + size,
+            'decks': get_decks(user),
             'now': datetime.datetime.now(),
-        }))
+        })
+
+class ExportGames(PokerRequestHandler):
+    def get(self, format):
+        user = self.get_user()
+        self.write_export(get_user_rows(user), 'games', format)
+
+class ExportGame(PokerRequestHandler):
+    def get(self, game_id, format):
+        user = self.get_user()
+        game = self.get_game(game_id)
+        self.write_export(get_game_rows(game), 'game-%d' % game.key.id(), format)
 
 class DeleteGame(PokerRequestHandler):
     def get(self, game_id):
         game = self.get_game(game_id, check_user = True)
-        game.delete()
+        game.schedule_delete()
         return self.redirect('/')
 
 class GamePage(PokerRequestHandler):
@@ -181,23 +313,39 @@ class GamePage(PokerRequestHandler):
         player = self.get_player()
         url = player.get_url(self.request.uri)
         game = self.get_game(game_id)
-        deck = json.dumps(game.get_deck())
-        participant_key = str(game.key().id()) + str(user.user_id())
-        participant = Participant.get_or_insert(
-            participant_key,
-            parent = game,
-            user = user
-        )
+        deck = json.dumps(game.get_deck().cards)
+        participant_key = str(game.key.id()) + str(user.user_id())
+        participant = self.get_identity_map().get(ndb.Key(Participant, participant_key, parent = game.key))
+        changed = False
+        if not participant:
+            participant = Participant.get_or_insert(
+                participant_key,
+                parent = game.key,
+                user = user
+            )
+            game.update_players()
+            changed = True
         if not participant.name or not participant.photo:
-            participant.name = player.get_name()
-            participant.photo = player.get_photo()
-            participant.put()
-        template = JINJA_ENVIRONMENT.get_template('game.html')
+            name = player.get_name()
+            photo = player.get_photo()
+            if participant.name != name or participant.photo != photo:
+                participant.name = name
+                participant.photo = photo
+                participant.put()
+                changed = True
         channel_id = participant_key
-        client_auth_token = create_custom_token(channel_id)
-        message = game.get_message()
-        initial_message = urllib.unquote(json.dumps(message))
-        self.response.write(template.render({
+        client_auth_token = create_custom_token(channel_id, claims = {
+            'game': str(game.key.id()),
+        })
+        if changed:
+            # The cached snapshot of this version was already published, so
+            # the change goes out as a new version instead of replacing it.
+            message = game.get_message()
+            game.queue_update()
+        else:
+            message = game.get_cached_message()
+        initial_message = json.dumps(encode_message(message, COMPACT_FORMAT))
+        self.render_template('game.html', {
             'user': user,
             'player_name': player.get_name(),
             'player_photo': player.get_photo(),
@@ -209,16 +357,31 @@ class GamePage(PokerRequestHandler):
             'token': client_auth_token,
             'channel_id': channel_id,
             'initial_message': initial_message,
-        }))
+        })
 
 class GameOpened(PokerRequestHandler):
     def post(self, game_id):
         user = self.get_user()
         game = self.get_game(game_id)
-        game.send_update()
+        participant_key = str(game.key.id()) + str(user.user_id())
+        estimates = game.get_user_estimates_async(user)
+        get_presence_cache().set_online(game.key.id(), participant_key)
+        set_client_format(game.key.id(), self.get_format())
+        pointer = None
+        if game.SHARED_STATE:
+            # The shared node already holds the game unless the client asks
+            # for a snapshot or it was never written in the format needed.
+            format, version = get_published(game.key.id())
+            if self.request.get('snapshot') or format != get_wire_format(game.key.id()):
+                game.send_update(full = True)
+            pointer = game.request_pointer(participant_key)
+        else:
+            game.send_update()
         response = {
-            'estimates': game.get_user_estimates(user),
+            'estimates': estimates.get_result(),
         }
+        if pointer is not None:
+            pointer.get_result()
         self.response.headers['Content-Type'] = 'application/json'
         self.response.write(json.dumps(response))
 
@@ -229,18 +392,10 @@ class ToggleCompleteGame(PokerRequestHandler):
 
     def post(self, game_id, toggle):
         game = self.get_game(game_id, check_user = True)
-        game.completed = toggle == 'complete'
-        if game.completed:
-            for story in game.get_stories():
-                for round in story.get_rounds():
-                    round.completed = True
-                    round.put()
-                if story.estimate is None:
-                    story.estimate = Story.SKIPPED
-                    story.put()
-        game.current_story_id = None
-        game.put()
-        game.send_update()
+        game = game.set_completed(toggle == 'complete')
+        if game.completed and not game.restoring:
+            game.schedule_archive()
+        game.queue_update()
 
 class NewStory(PokerRequestHandler):
     def post(self, game_id):
@@ -248,38 +403,26 @@ class NewStory(PokerRequestHandler):
         current_story = game.get_current_story()
         if game.completed or current_story:
             self.abort(403)
+        name = self.request.get('name')
+        if not name:
+            self.abort(400)
         try:
-            story = Story(
-                parent = game,
-                name = self.request.get('name')
-            )
+            game = game.new_story(name)
         except:
             self.abort(400)
-        story.put()
-        story.new_round()
-        game.current_story_id = story.key().id()
-        game.put()
-        game.send_update()
+        game.queue_update()
 
 class SkipStory(PokerRequestHandler):
     def post(self, game_id, story_id):
         story = self.get_story(game_id, story_id, check_user = True)
-        rounds = story.get_rounds()
-        for round in rounds:
-            round.completed = True
-            round.put()
-        story.estimate = Story.SKIPPED
-        story.put()
-        game = story.parent()
-        game.current_story_id = None
-        game.put()
-        game.send_update()
+        game = story.complete(Story.SKIPPED, self.get_parent(story))
+        game.queue_update()
 
 class CompleteStory(PokerRequestHandler):
     def post(self, game_id, story_id):
         story = self.get_story(game_id, story_id, check_user = True)
-        game = story.parent()
-        if game.completed or not story.is_current():
+        game = self.get_parent(story)
+        if game.completed or not story.is_current(game):
             self.abort(403)
         deck = game.get_deck()
         card = self.request.get('card')
@@ -287,47 +430,37 @@ class CompleteStory(PokerRequestHandler):
             card = int(card)
         except ValueError:
             self.abort(400)
-        try:
-            estimate = deck[card]
-        except IndexError:
+        if not deck.has_card(card):
             self.abort(400)
-        rounds = story.get_rounds()
-        for round in rounds:
-            round.completed = True
-            round.put()
-        story.estimate = card
-        story.put()
-        game.current_story_id = None
-        game.put()
-        game.send_update()
+        game = story.complete(card, game)
+        game.queue_update()
 
 class NewRound(PokerRequestHandler):
     def post(self, game_id, story_id):
         story = self.get_story(game_id, story_id, check_user = True)
-        game = story.parent()
-        if game.completed or not story.is_current():
+        game = self.get_parent(story)
+        if game.completed or not story.is_current(game):
             self.abort(403)
-        story.new_round()
-        game.send_update()
+        story.new_round(game)
+        game.queue_update()
 
 class CompleteRound(PokerRequestHandler):
     def post(self, game_id, story_id, round_id):
         round = self.get_round(game_id, story_id, round_id, check_user = True)
-        story = round.parent()
-        game = story.parent()
-        if game.completed or not story.is_current():
+        story = self.get_parent(round)
+        game = self.get_parent(story)
+        if game.completed or not story.is_current(game):
             self.abort(403)
-        round.completed = True
-        round.put()
-        game.send_update()
+        round.complete(game)
+        game.queue_update()
 
 class EstimateRound(PokerRequestHandler):
     def post(self, game_id, story_id, round_id):
         round = self.get_round(game_id, story_id, round_id)
         user = self.get_user()
-        story = round.parent()
-        game = story.parent()
-        if game.completed or not story.is_current() or round.completed:
+        story = self.get_parent(round)
+        game = self.get_parent(story)
+        if game.completed or not story.is_current(game) or round.completed:
             self.abort(403)
         deck = game.get_deck()
         card = self.request.get('card')
@@ -335,46 +468,89 @@ class EstimateRound(PokerRequestHandler):
             card = int(card)
         except ValueError:
             self.abort(400)
-        try:
-            estimate = deck[card]
-        except IndexError:
+        if not deck.has_card(card):
             self.abort(400)
-        estimate_key = str(round.key().id()) + str(user.user_id())
-        estimate = Estimate.get_or_insert(
-            estimate_key,
-            parent = round,
-            user = user,
-            card = card
-        )
-        estimate.put()
-        count_participants = game.get_participants().filter('observer =', False).count()
-        count_estimates = round.get_estimates().count()
-        if count_participants == count_estimates:
-            round.completed = True
-            round.put()
-        game.send_update(force = round.completed, user = user)
+        round = round.add_vote(user, card, game)
+        if round.completed:
+            game.queue_update()
+        else:
+            game.schedule_update()
 
 class ToggleGameObserver(PokerRequestHandler):
     def post(self, game_id, participant_key, observer):
         participant = self.get_participant(game_id, participant_key, check_user = True)
         participant.observer = observer == 'observer'
         participant.put()
-        game = participant.parent()
-        game.send_update()
+        game = self.get_parent(participant)
+        game.update_players()
+        game.queue_update()
 
 class DeleteParticipant(PokerRequestHandler):
     def post(self, game_id, participant_key):
         participant = self.get_participant(game_id, participant_key, check_user = True)
-        game = participant.parent()
+        game = self.get_parent(participant)
         if game.user == participant.user:
             self.abort(403)
-        participant.delete()
-        game.send_update()
+        participant.key.delete()
+        get_presence_cache().set_offline(game.key.id(), participant.key.id())
+        game.update_players()
+        game.queue_update()
+
+class GamePresence(PokerRequestHandler):
+    def post(self, game_id):
+        game = self.get_game(game_id)
+        user = self.get_user()
+        participant_key = str(game.key.id()) + str(user.user_id())
+        get_presence_cache().set_online(game.key.id(), participant_key)
 
 class GameClosed(PokerRequestHandler):
     def post(self, game_id):
         game = self.get_game(game_id)
         user = self.get_user()
-        participant_key = str(game.key().id()) + str(user.user_id())
+        participant_key = str(game.key.id()) + str(user.user_id())
         channel_id = participant_key
+        get_presence_cache().set_offline(game.key.id(), channel_id)
         send_firebase_message(channel_id, None)
+
+class UpdateGame(PokerRequestHandler):
+    def post(self, game_id):
+        game = Game.get_by_id(int(game_id))
+        if game and not game.deleting:
+            game.send_update()
+
+class PurgeGame(PokerRequestHandler):
+    def post(self, game_id):
+        game = Game.get_by_id(int(game_id))
+        if game:
+            game.delete()
+
+class ArchiveGame(PokerRequestHandler):
+    def post(self, game_id):
+        game = Game.get_by_id(int(game_id))
+        if game and game.completed and not game.archived and not game.deleting:
+            game.archive()
+
+class RestoreGame(PokerRequestHandler):
+    def post(self, game_id):
+        game = Game.get_by_id(int(game_id))
+        if game and game.restoring and not game.deleting:
+            game = game.restore()
+            game.queue_update()
+
+class UpdateGameSummaries(PokerRequestHandler):
+    def get(self):
+        Game.update_summaries()
+
+    def post(self):
+        cursor = self.request.get('cursor')
+        Game.update_summaries(Cursor(urlsafe = cursor) if cursor else None)
+
+class ProfileStatsPage(PokerRequestHandler):
+    def get(self):
+        stats = {
+            'routes': get_profile_stats().get_stats(),
+            'snapshot_cache': get_snapshot_cache().get_stats(),
+            'token_cache': get_token_cache().get_stats(),
+        }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
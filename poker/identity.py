@@ -0,0 +1,34 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+from google.appengine.ext import ndb
+
+__all__ = [
+    'IdentityMap',
+]
+
+class IdentityMap(object):
+    # ndb's context cache already saves the RPC of a repeated get. On top of
+    # that, the map loads the entities named by a URL with one get_multi and
+    # gives every handler helper the same instance per key, including the
+    # parents passed on to the model methods. Model methods that change an
+    # entity in a transaction return a new instance; the map keeps the one
+    # it loaded, so handlers use the returned entity from then on.
+
+    def __init__(self):
+        self.entities = {}
+
+    def get(self, key):
+        if key not in self.entities:
+            self.entities[key] = key.get()
+        return self.entities[key]
+
+    def get_multi(self, keys):
+        missing = [key for key in keys if key not in self.entities]
+        if missing:
+            for key, entity in zip(missing, ndb.get_multi(missing)):
+                self.entities[key] = entity
+        return [self.entities[key] for key in keys]
+
+    def get_parent(self, entity):
+        return self.get(entity.key.parent())
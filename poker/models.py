@@ -2,13 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import json
-import datetime
+import time
+import zlib
+import struct
+import logging
 
 from jinja2.utils import urlize
 
-from google.appengine.ext import db
+from google.appengine.api import taskqueue
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
 
-from poker.firebase import send_firebase_message
+from poker.cache import get_snapshot_cache, get_presence_cache, get_vote_tally
+from poker.decks import get_deck
+from poker.delta import get_updates
+from poker.firebase import request_firebase_message, send_firebase_messages, send_game_message, send_game_updates, request_game_message
+from poker.records import ParticipantRecord, StoryRecord, RoundRecord, EstimateRecord
+from poker.stats import get_rounds_stats, get_totals
+from poker.wire import encode_message, get_wire_format, get_published, set_published, lock_publish, unlock_publish
 
 __all__ = [
     'Game',
@@ -16,119 +27,421 @@ __all__ = [
     'Story',
     'Round',
     'Estimate',
+    'Vote',
+    'GameArchive',
+    'GameSnapshot',
 ]
 
-class Game(db.Model):
-    DECK_CHOICES = (
-        (1 , ('1', '2', '3', '5', '8', '13', '21', '100', '?', 'Coffee')),
-        (2 , ('0', '1/2' , '1', '2', '3', '5', '8', '13', '20', '40', '60', '100', '?', 'oo')),
-        (3 , ('0', '1', '2', '3', '5', '8', '13', '21', '44', '?', 'oo')),
-    )
-    name = db.StringProperty(required = True)
-    deck = db.IntegerProperty(required = True, choices = [deck[0] for deck in DECK_CHOICES])
-    completed = db.BooleanProperty(default = False)
-    user = db.UserProperty(required = True)
-    current_story_id = db.IntegerProperty()
-    created = db.DateTimeProperty(auto_now_add = True)
+class Game(ndb.Model):
+    SHARED_STATE = True
+    UPDATE_WINDOW = 1
+    PUBLISH_WAIT = 0.1
+    PUBLISH_RETRIES = 30
+    DELETE_BATCH = 500
+    SUMMARY_BATCH = 100
+    ARCHIVE_DELAY = 60 * 60
+    ARCHIVE_DELETE = True
+    LIST_PROJECTION = ('name', 'deck', 'completed', 'created', 'stories')
+    name = ndb.StringProperty(required = True)
+    deck = ndb.IntegerProperty(required = True)
+    completed = ndb.BooleanProperty(default = False)
+    user = ndb.UserProperty(required = True)
+    current_story_id = ndb.IntegerProperty()
+    created = ndb.DateTimeProperty(auto_now_add = True)
+    version = ndb.IntegerProperty(default = 0)
+    players = ndb.IntegerProperty()
+    deleting = ndb.BooleanProperty(default = False)
+    stories = ndb.IntegerProperty()
+    archived = ndb.BooleanProperty(default = False)
+    restoring = ndb.BooleanProperty(default = False)
     
     def get_deck(self):
-        for deck in self.DECK_CHOICES:
-            if self.deck == deck[0]:
-                return deck[1]
-        return ()
+        return get_deck(self.deck)
     
     def get_participants(self):
-        return Participant.all().ancestor(self).order("created")
+        return Participant.query(ancestor = self.key).order(Participant.created)
     
     def get_stories(self):
-        return Story.all().ancestor(self).order("created")
+        return Story.query(ancestor = self.key).order(Story.created)
+    
+    def get_players(self):
+        if self.players is None:
+            return self.update_players()
+        return self.players
+    
+    @ndb.transactional
+    def update_players(self):
+        game = self.key.get()
+        game.players = game.get_participants().filter(Participant.observer == False).count()
+        game.put()
+        self.players = game.players
+        return self.players
+    
+    def count_stories(self):
+        archive = self.get_archive()
+        if archive is not None:
+            return len(archive.get_entities(Story))
+        return Story.query(ancestor = self.key).count()
+    
+    @ndb.transactional
+    def update_summary(self):
+        game = self.key.get()
+        game.stories = game.count_stories()
+        game.put()
+        self.stories = game.stories
+        return game
+    
+    def get_online_participants(self):
+        online = get_presence_cache().get(self.key.id())
+        if online is None:
+            # Presence was never recorded or has been evicted, so nobody can
+            # be ruled out.
+            return list(self.get_participants())
+        keys = [ndb.Key(Participant, channel_id, parent = self.key) for channel_id in online]
+        return [participant for participant in ndb.get_multi(keys) if participant]
     
     def get_url(self):
-        game_url = '/game/' + str(self.key().id())
+        game_url = '/game/' + str(self.key.id())
         return game_url
     
     def get_current_story(self):
         if not self.current_story_id:
             return None
-        return Story.get_by_id(self.current_story_id, self)
-    
-    def get_participant_messages(self):
-        messages = []
-        for participant in self.get_participants():
-            message = participant.get_message()
-            messages.append(message)
-        return messages
-    
-    def get_story_messages(self):
-        messages = []
-        for story in self.get_stories():
-            message = story.get_message()
-            messages.append(message)
-        return messages
+        return Story.get_by_id(self.current_story_id, parent = self.key)
+    
+    def get_users(self):
+        return [participant.user for participant in self.get_participants()]
+    
+    def get_open_votes(self, users, ancestor = None):
+        round_keys = Round.query(ancestor = ancestor or self.key).filter(Round.completed == False).fetch(keys_only = True)
+        if not round_keys:
+            return {}
+        return Round.get_votes_multi(round_keys, users)
+    
+    def set_completed(self, completed):
+        if not completed and self.archived:
+            # The restore task reopens the game once its entities are back.
+            return self.schedule_restore()
+        users = self.get_users() if completed else []
+        votes = self.get_open_votes(users) if completed else {}
+        @ndb.transactional
+        def update():
+            game = self.key.get()
+            game.completed = completed
+            game.current_story_id = None
+            entities = [game]
+            round_keys = []
+            if completed:
+                for round in Round.query(ancestor = game.key):
+                    if not round.completed:
+                        round.completed = True
+                        entities.extend(round.fold_votes(votes.get(round.key, [])))
+                        entities.append(round)
+                        round_keys.append(round.key)
+                for story in Story.query(ancestor = game.key):
+                    if story.estimate is None:
+                        story.estimate = Story.SKIPPED
+                        entities.append(story)
+            ndb.put_multi(entities)
+            return game, round_keys
+        game, round_keys = update()
+        Round.fold_late_votes(round_keys, users, votes)
+        return game
+    
+    @ndb.transactional
+    def new_story(self, name):
+        game = self.key.get()
+        if game.stories is None:
+            game.stories = game.count_stories()
+        game.stories += 1
+        story = Story(
+            parent = game.key,
+            name = name
+        )
+        story.put()
+        round = Round(
+            parent = story.key,
+            votes = 0
+        )
+        game.current_story_id = story.key.id()
+        ndb.put_multi([round, game])
+        get_vote_tally().start(round.key.urlsafe())
+        return game
+    
+    @classmethod
+    def update_summaries(cls, cursor = None):
+        games, cursor, more = cls.query().fetch_page(cls.SUMMARY_BATCH, start_cursor = cursor)
+        for game in games:
+            if game.stories is None:
+                game.update_summary()
+        if more:
+            taskqueue.add(
+                url = '/tasks/game/summary',
+                params = {'cursor': cursor.urlsafe()}
+            )
+    
+    def get_archive(self):
+        if not self.archived:
+            return None
+        return GameArchive.get_key(self.key).get()
     
-    def get_current_story_message(self):
-        current_story = self.get_current_story()
-        if not current_story:
-            return None 
-        return current_story.get_message()
+    def get_snapshot(self):
+        return GameSnapshot(self, self.get_archive())
     
     def get_message(self):
-        message = {
-            'id': self.key().id(),
-            'name': self.name,
-            'deck': self.get_deck(),
-            'completed': self.completed,
-            'user': self.user.user_id(),
-            'current_story': self.get_current_story_message(),
-            'url': self.get_url(),
-            'participants': self.get_participant_messages(),
-            'stories': self.get_story_messages(),
-        }
+        return self.get_snapshot().get_message()
+    
+    def get_cached_message(self):
+        cache = get_snapshot_cache()
+        message = cache.get(self.key.id(), self.version)
+        if message is None:
+            message = self.get_message()
+            cache.set(self.key.id(), self.version, message)
         return message
     
-    def send_update(self, force = True, user = None):
+    def invalidate_message(self):
+        get_snapshot_cache().delete(self.key.id(), self.version)
+    
+    def next_version(self):
+        @ndb.transactional
+        def increment():
+            game = self.key.get()
+            game.version = (game.version or 0) + 1
+            game.put()
+            return game.version
+        self.version = increment()
+        return self.version
+    
+    def schedule_update(self):
+        now = time.time()
+        bucket = int(now // self.UPDATE_WINDOW)
+        try:
+            taskqueue.add(
+                name = 'update-{}-{}'.format(self.key.id(), bucket),
+                url = '/tasks/game/{}/update'.format(self.key.id()),
+                countdown = (bucket + 1) * self.UPDATE_WINDOW - now
+            )
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+    
+    def queue_update(self):
+        taskqueue.add(
+            url = '/tasks/game/{}/update'.format(self.key.id())
+        )
+    
+    def send_update(self, full = False):
+        version = self.next_version()
         message = self.get_message()
-        message = json.dumps(message)
-        participants = self.get_participants()
-        for participant in participants:
-            if user and participant.user == user:
-                force = True
-            participant.send_update(message, force)
+        get_snapshot_cache().set(self.key.id(), version, message)
+        format = get_wire_format(self.key.id())
+        if self.SHARED_STATE:
+            return self.publish(message, format, full)
+        message = json.dumps(encode_message(message, format))
+        return self.send_messages(self.get_online_participants(), message)
+    
+    def publish(self, message, format, full = False):
+        # Publishes of a game are serialized, otherwise a slow delta could
+        # land on top of a newer node.
+        for i in range(self.PUBLISH_RETRIES):
+            locked = lock_publish(self.key.id())
+            if locked:
+                break
+            time.sleep(self.PUBLISH_WAIT)
+        else:
+            logging.warning('Publishing game %s without the lock', self.key.id())
+        try:
+            return self.write_published(message, format, full or not locked)
+        finally:
+            if locked:
+                unlock_publish(self.key.id())
+    
+    def write_published(self, message, format, full = False):
+        cache = get_snapshot_cache()
+        published_format, published_version = get_published(self.key.id())
+        if published_version >= self.version:
+            # A newer snapshot is already out.
+            return None
+        previous = None
+        # A delta only applies on top of the version before, written in the
+        # same format.
+        if not full and published_format == format and published_version == self.version - 1:
+            previous = cache.get(self.key.id(), self.version - 1, local = False)
+        message = encode_message(message, format)
+        if previous is not None:
+            updates = get_updates(encode_message(previous, format), message)
+            response, content = send_game_updates(self.key.id(), json.dumps(updates))
+            if response.status < 400:
+                set_published(self.key.id(), format, self.version)
+                return response
+        response, content = send_game_message(self.key.id(), json.dumps(message))
+        if response.status >= 400:
+            cache.delete(self.key.id(), self.version)
+            logging.warning('Could not publish game %s: %s', self.key.id(), content)
+        else:
+            set_published(self.key.id(), format, self.version)
+        return response
     
-    def get_user_estimates(self, user):
+    def request_pointer(self, participant_key):
+        message = {
+            'game': self.key.id(),
+            'version': self.version,
+        }
+        return request_firebase_message(participant_key, json.dumps(message))
+    
+    def send_messages(self, participants, message):
+        if not participants:
+            return {}
+        messages = dict((participant.key.id(), message) for participant in participants)
+        errors = send_firebase_messages(messages)
+        for channel_id, error in errors.items():
+            if error:
+                logging.warning('Could not update channel %s: %s', channel_id, error)
+        return errors
+    
+    @ndb.tasklet
+    def get_user_estimates_async(self, user):
         estimates = {}
-        if not user:
-            return estimates
-        for story in self.get_stories():
-            for round in story.get_rounds():
-                estimate = round.get_estimate(user)
-                round_id = round.key().id()
-                if estimate:
-                    card = estimate.card
-                    estimates[round_id] = card
-        return estimates
+        if not user or self.archived:
+            raise ndb.Return(estimates)
+        # Votes only exist until their round is folded.
+        round_keys, open_keys = yield (
+            Round.query(ancestor = self.key).fetch_async(keys_only = True),
+            Round.query(ancestor = self.key).filter(Round.completed == False).fetch_async(keys_only = True),
+        )
+        keys = [Round.get_estimate_key(round_key, user) for round_key in round_keys]
+        keys += [Vote.get_key(round_key, user) for round_key in open_keys]
+        entities = yield ndb.get_multi_async(keys)
+        for entity in entities:
+            if isinstance(entity, Estimate):
+                estimates[entity.key.parent().id()] = entity.card
+            elif entity:
+                estimates.setdefault(entity.round.id(), entity.card)
+        raise ndb.Return(estimates)
     
-    def delete(self, **kwargs):
-        participants = self.get_participants()
-        for participant in participants:
-            participant.send_update(None, True)
-        db.delete(Participant.all(keys_only = True).ancestor(self))
-        stories = self.get_stories()
-        for story in stories:
-            story.delete()
-        super(Game, self).delete(**kwargs)
-
-class Participant(db.Model):
-    user = db.UserProperty(required = True)
-    name = db.StringProperty()
-    photo = db.StringProperty()
-    created = db.DateTimeProperty(auto_now_add = True)
-    observer = db.BooleanProperty(required = True, default = False)
-    last_update = db.DateTimeProperty(auto_now_add = True)
+    def get_user_estimates(self, user):
+        return self.get_user_estimates_async(user).get_result()
+    
+    @ndb.transactional
+    def mark_deleting(self):
+        game = self.key.get()
+        game.deleting = True
+        game.put()
+        self.deleting = True
+    
+    def schedule_archive(self):
+        taskqueue.add(
+            url = '/tasks/game/{}/archive'.format(self.key.id()),
+            countdown = self.ARCHIVE_DELAY
+        )
     
-    def get_url(self):
-        game_url = self.parent().get_url()
-        participant_url = game_url + '/participant/' + self.key().name()
+    def archive(self):
+        entities = []
+        for kind in (Story, Round, Estimate):
+            entities += kind.query(ancestor = self.key).fetch()
+        archive = GameArchive.create(self.key, entities)
+        if archive is None:
+            logging.warning('Game %s is too large to archive', self.key.id())
+            return False
+        @ndb.transactional
+        def update():
+            game = self.key.get()
+            if not game.completed or game.archived or game.deleting:
+                return None
+            game.archived = True
+            if game.stories is None:
+                game.stories = len([entity for entity in entities if isinstance(entity, Story)])
+            ndb.put_multi([game, archive])
+            return game
+        game = update()
+        if game is None:
+            return False
+        self.archived = True
+        # All rounds are folded by now, so any vote left over is redundant.
+        ndb.delete_multi(Vote.query(Vote.game == self.key).fetch(keys_only = True))
+        if self.ARCHIVE_DELETE:
+            @ndb.transactional
+            def delete(keys):
+                # Runs in the game's entity group, so it cannot interleave
+                # with schedule_restore() setting the flag.
+                game = self.key.get()
+                if not game.archived or game.restoring:
+                    return False
+                ndb.delete_multi(keys)
+                return True
+            keys = [entity.key for entity in entities]
+            for i in range(0, len(keys), self.DELETE_BATCH):
+                if not delete(keys[i:i + self.DELETE_BATCH]):
+                    break
+        return True
+    
+    @ndb.transactional
+    def schedule_restore(self):
+        game = self.key.get()
+        game.restoring = True
+        game.put()
+        taskqueue.add(
+            url = '/tasks/game/{}/restore'.format(self.key.id()),
+            transactional = True
+        )
+        return game
+    
+    def restore(self):
+        # Until it is restored the game stays archived and completed, and is
+        # read from the archive. Putting the entities back can be repeated, so
+        # a restore that fails part way is simply retried by the task queue.
+        archive = GameArchive.get_key(self.key).get()
+        if archive:
+            entities = archive.get_entities()
+            for i in range(0, len(entities), self.DELETE_BATCH):
+                ndb.put_multi(entities[i:i + self.DELETE_BATCH])
+        @ndb.transactional
+        def update():
+            game = self.key.get()
+            if not game.restoring:
+                return game
+            game.archived = False
+            game.restoring = False
+            game.completed = False
+            game.current_story_id = None
+            game.put()
+            GameArchive.get_key(self.key).delete()
+            return game
+        return update()
+    
+    def schedule_delete(self):
+        self.mark_deleting()
+        taskqueue.add(
+            url = '/tasks/game/{}/delete'.format(self.key.id())
+        )
+    
+    def delete(self):
+        keys = ndb.Query(ancestor = self.key).fetch(keys_only = True)
+        messages = {}
+        for key in keys:
+            if key.kind() == 'Participant':
+                messages[key.id()] = None
+        rpc = request_game_message(self.key.id(), None)
+        send_firebase_messages(messages)
+        rpc.get_result()
+        self.invalidate_message()
+        keys = [key for key in keys if key != self.key]
+        keys += Vote.query(Vote.game == self.key).fetch(keys_only = True)
+        for i in range(0, len(keys), self.DELETE_BATCH):
+            ndb.delete_multi(keys[i:i + self.DELETE_BATCH])
+        self.key.delete()
+
+class Participant(ndb.Model):
+    user = ndb.UserProperty(required = True)
+    name = ndb.StringProperty()
+    photo = ndb.StringProperty()
+    created = ndb.DateTimeProperty(auto_now_add = True)
+    observer = ndb.BooleanProperty(required = True, default = False)
+    
+    def get_url(self, game = None):
+        if game is None:
+            game = self.key.parent().get()
+        game_url = game.get_url()
+        participant_url = game_url + '/participant/' + self.key.id()
         return participant_url
     
     def get_name(self):
@@ -137,162 +450,473 @@ class Participant(db.Model):
         else:
             return self.user.nickname()
     
-    def get_message(self):
+    def get_message(self, game = None):
         message = {
             'user': self.user.user_id(),
             'name': self.get_name(),
             'photo': self.photo,
             'observer': self.observer,
-            'url': self.get_url()
+            'url': self.get_url(game)
         }
         return message
-    
-    def send_update(self, message, force):
-        if force or self.need_update():
-            self.last_update = datetime.datetime.now()
-            self.put()
-            send_firebase_message(self.key().name(), message)
-    
-    def need_update(self):
-        return datetime.datetime.now() - self.last_update > datetime.timedelta(seconds = 1)
 
-class Story(db.Model):
+class Story(ndb.Model):
     SKIPPED = -1
-    name = db.StringProperty(required = True)
-    estimate = db.IntegerProperty()
-    created = db.DateTimeProperty(auto_now_add = True)
+    name = ndb.StringProperty(required = True)
+    estimate = ndb.IntegerProperty()
+    created = ndb.DateTimeProperty(auto_now_add = True)
     
     def get_rounds(self):
-        return Round.all().ancestor(self).order("created")
+        return Round.query(ancestor = self.key).order(Round.created)
     
-    def get_estimate(self):
-        game = self.parent()
+    def get_estimate(self, game = None):
+        if game is None:
+            game = self.key.parent().get()
         deck = game.get_deck()
         card = self.estimate
         if card == self.SKIPPED:
             return card
         if card is None:
             return None
-        try:
-            estimate = deck[card]
-        except IndexError:
-            return None
-        return estimate
+        return deck.get_card(card)
     
     def get_name_display(self):
         return urlize(self.name, 80)
     
-    def get_url(self):
-        game_url = self.parent().get_url()
-        story_url = game_url + '/story/' + str(self.key().id())
+    def get_url(self, game = None):
+        if game is None:
+            game = self.key.parent().get()
+        game_url = game.get_url()
+        story_url = game_url + '/story/' + str(self.key.id())
         return story_url
     
-    def is_current(self):
-        game = self.parent()
-        is_current = game.current_story_id == self.key().id()
+    def is_current(self, game = None):
+        if game is None:
+            game = self.key.parent().get()
+        is_current = game.current_story_id == self.key.id()
         return is_current
     
-    def new_round(self):
-        rounds = self.get_rounds()
-        for round in rounds:
-            round.completed = True
-            round.put()
-        round = Round(
-            parent = self
-        )
-        round.put()
-        self.estimate = None
-        self.put()
+    def new_round(self, game = None):
+        if game is None:
+            game = self.key.parent().get()
+        users = game.get_users()
+        votes = game.get_open_votes(users, self.key)
+        @ndb.transactional
+        def update():
+            story = self.key.get()
+            entities = []
+            round_keys = []
+            for round in story.get_rounds():
+                if not round.completed:
+                    round.completed = True
+                    entities.extend(round.fold_votes(votes.get(round.key, [])))
+                    entities.append(round)
+                    round_keys.append(round.key)
+            round = Round(
+                parent = story.key,
+                votes = 0
+            )
+            story.estimate = None
+            ndb.put_multi(entities + [round, story])
+            return round, round_keys
+        round, round_keys = update()
+        get_vote_tally().start(round.key.urlsafe())
+        Round.fold_late_votes(round_keys, users, votes)
         return round
     
-    def get_round_messages(self):
+    def complete(self, estimate, game = None):
+        if game is None:
+            game = self.key.parent().get()
+        users = game.get_users()
+        votes = game.get_open_votes(users, self.key)
+        @ndb.transactional
+        def update():
+            story = self.key.get()
+            game = story.key.parent().get()
+            entities = []
+            round_keys = []
+            for round in story.get_rounds():
+                if not round.completed:
+                    round.completed = True
+                    entities.extend(round.fold_votes(votes.get(round.key, [])))
+                    entities.append(round)
+                    round_keys.append(round.key)
+            story.estimate = estimate
+            game.current_story_id = None
+            ndb.put_multi(entities + [story, game])
+            return game, round_keys
+        game, round_keys = update()
+        Round.fold_late_votes(round_keys, users, votes)
+        return game
+    
+    def get_round_messages(self, game = None, rounds = None, estimates = None):
         messages = []
-        if not self.is_current():
+        if game is None:
+            game = self.key.parent().get()
+        if not self.is_current(game):
             return messages
-        for round in self.get_rounds():
-            message = round.get_message()
+        if rounds is None:
+            rounds = self.get_rounds()
+        for round in rounds:
+            round_estimates = None
+            if estimates is not None:
+                round_estimates = estimates.get(round.key, [])
+            message = round.get_message(self, game, round_estimates)
             messages.append(message)
         return messages
     
-    def get_message(self):
+    def get_message(self, game = None, rounds = None, estimates = None):
+        if game is None:
+            game = self.key.parent().get()
         message = {
-            'id': self.key().id(),
+            'id': self.key.id(),
             'name': self.get_name_display(),
-            'estimate': self.get_estimate(),
-            'url': self.get_url(),
-            'is_current': self.is_current(),
-            'rounds': self.get_round_messages(),
+            'estimate': self.get_estimate(game),
+            'url': self.get_url(game),
+            'is_current': self.is_current(game),
+            'rounds': self.get_round_messages(game, rounds, estimates),
         }
         return message
-    
-    def delete(self, **kwargs):
-        rounds = self.get_rounds()
-        for round in rounds:
-            round.delete()
-        super(Story, self).delete(**kwargs)
 
-class Round(db.Model):
-    completed = db.BooleanProperty(default = False)
-    created = db.DateTimeProperty(auto_now_add = True)
+class Round(ndb.Model):
+    completed = ndb.BooleanProperty(default = False)
+    created = ndb.DateTimeProperty(auto_now_add = True)
+    voters = ndb.StringProperty(repeated = True)
+    votes = ndb.IntegerProperty()
     
     def get_estimates(self):
-        return Estimate.all().ancestor(self).order("created")
+        return Estimate.query(ancestor = self.key).order(Estimate.created)
     
-    def get_url(self):
-        story_url = self.parent().get_url()
-        round_url = story_url + '/round/' + str(self.key().id())
+    def get_url(self, story = None, game = None):
+        if story is None:
+            story = self.key.parent().get()
+        story_url = story.get_url(game)
+        round_url = story_url + '/round/' + str(self.key.id())
         return round_url
     
+    @staticmethod
+    def get_estimate_key(round_key, user):
+        estimate_key = str(round_key.id()) + str(user.user_id())
+        return ndb.Key(Estimate, estimate_key, parent = round_key)
+    
     def get_estimate(self, user):
         if not user:
             return None
-        estimate_key = str(self.key().id()) + str(user.user_id())
-        estimate = Estimate.get_by_key_name(estimate_key, self)
+        estimate = Round.get_estimate_key(self.key, user).get()
         return estimate
     
-    def get_estimate_messages(self):
+    @staticmethod
+    def get_votes_multi(round_keys, users):
+        keys = [Vote.get_key(round_key, user) for round_key in round_keys for user in users]
+        votes = {}
+        for vote in ndb.get_multi(keys):
+            if vote:
+                votes.setdefault(vote.round, []).append(vote)
+        return votes
+    
+    @staticmethod
+    def fold_late_votes(round_keys, users, votes):
+        # The votes of completed rounds are read before the completing
+        # transaction, so votes stored in between are folded afterwards.
+        # Votes stored later still find the round completed and fold
+        # themselves in add_vote. Folded votes live on as estimates and are
+        # deleted.
+        if not round_keys:
+            return
+        folded = []
+        for round_key, round_votes in Round.get_votes_multi(round_keys, users).items():
+            known = set(vote.key for vote in votes.get(round_key, []))
+            late = [vote for vote in round_votes if vote.key not in known]
+            if late:
+                Round.fold(round_key, late)
+            folded.extend(vote.key for vote in round_votes)
+        ndb.delete_multi(folded)
+    
+    def get_votes(self, game = None):
+        if game is None:
+            game = self.key.parent().parent().get()
+        return Round.get_votes_multi([self.key], game.get_users()).get(self.key, [])
+    
+    def add_vote(self, user, card, game = None):
+        if game is None:
+            game = self.key.parent().parent().get()
+        vote, created = Vote.insert(self.key, game.key, user, card)
+        # The round is read after the vote is stored, and completion reads the
+        # votes after the round is stored, so one of them folds this vote. The
+        # read runs while the tally is updated.
+        round = self.key.get_async(use_cache = False, use_memcache = False)
+        tally = get_vote_tally()
+        round_id = self.key.urlsafe()
+        count = tally.incr(round_id) if created else tally.get(round_id)
+        if count is None:
+            # The tally was evicted, so the votes are counted once instead.
+            count = len(self.get_votes(game))
+            tally.start(round_id, count)
+        if count >= game.get_players():
+            return self.complete(game)
+        round = round.get_result()
+        if round.completed:
+            round = Round.fold(self.key, [vote])
+            vote.key.delete()
+        return round
+    
+    def fold_votes(self, votes):
+        # Turns the votes of a round that is being completed into its
+        # estimates. Callers put the estimates together with the round.
+        if self.votes is None:
+            self.voters = [estimate.user.user_id() for estimate in self.get_estimates()]
+        estimates = []
+        for vote in sorted(votes, key = lambda vote: vote.created):
+            user_id = vote.user.user_id()
+            if user_id in self.voters:
+                continue
+            estimates.append(Estimate(
+                key = Round.get_estimate_key(self.key, vote.user),
+                user = vote.user,
+                card = vote.card,
+                created = vote.created
+            ))
+            self.voters.append(user_id)
+        self.votes = len(self.voters)
+        return estimates
+    
+    @staticmethod
+    @ndb.transactional
+    def fold(round_key, votes):
+        round = round_key.get()
+        entities = round.fold_votes(votes)
+        if entities or not round.completed:
+            round.completed = True
+            ndb.put_multi(entities + [round])
+        return round
+    
+    def complete(self, game = None):
+        if game is None:
+            game = self.key.parent().parent().get()
+        users = game.get_users()
+        votes = Round.get_votes_multi([self.key], users)
+        round = Round.fold(self.key, votes.get(self.key, []))
+        Round.fold_late_votes([self.key], users, votes)
+        return round
+    
+    def get_estimate_messages(self, game = None, estimates = None):
         messages = []
-        for estimate in self.get_estimates():
-            message = estimate.get_message()
+        if estimates is None:
+            estimates = self.get_estimates()
+        for estimate in estimates:
+            message = estimate.get_message(self, game)
             messages.append(message)
         return messages
     
-    def get_message(self):
+    def get_message(self, story = None, game = None, estimates = None):
         message = {
-            'id': self.key().id(),
+            'id': self.key.id(),
             'completed': self.completed,
-            'url': self.get_url(),
-            'estimates': self.get_estimate_messages(),
+            'url': self.get_url(story, game),
+            'estimates': self.get_estimate_messages(game, estimates),
         }
         return message
-    
-    def delete(self, **kwargs):
-        db.delete(Estimate.all(keys_only = True).ancestor(self))
-        super(Round, self).delete(**kwargs)
 
-class Estimate(db.Model):
-    user = db.UserProperty(required = True)
-    card = db.IntegerProperty(required = True)
-    created = db.DateTimeProperty(auto_now_add = True)
+class Estimate(ndb.Model):
+    user = ndb.UserProperty(required = True)
+    card = ndb.IntegerProperty(required = True)
+    created = ndb.DateTimeProperty(auto_now_add = True)
     
-    def get_message(self):
+    def get_message(self, round = None, game = None):
         message = {
             'user': self.user.user_id(),
             'name': self.user.nickname(),
-            'card': self.get_card(),
+            'card': self.get_card(round, game),
         }
         return message
     
-    def get_card(self):
-        round = self.parent()
+    def get_card(self, round = None, game = None):
+        if round is None:
+            round = self.key.parent().get()
         if not round.completed:
             return None
-        story = round.parent()
-        game = story.parent()
+        if game is None:
+            story = round.key.parent().get()
+            game = story.key.parent().get()
         deck = game.get_deck()
-        card = self.card
-        try:
-            estimate = deck[card]
-        except IndexError:
+        return deck.get_card(self.card)
+
+class Vote(ndb.Model):
+    # Votes are root entities, so concurrent voters never contend on the
+    # game's entity group. They are folded into estimates when the round
+    # completes.
+    game = ndb.KeyProperty(required = True)
+    round = ndb.KeyProperty(required = True, indexed = False)
+    user = ndb.UserProperty(required = True)
+    card = ndb.IntegerProperty(required = True, indexed = False)
+    created = ndb.DateTimeProperty(auto_now_add = True)
+    
+    @staticmethod
+    def get_key(round_key, user):
+        vote_key = '-'.join(str(pair[1]) for pair in round_key.pairs()) + '-' + str(user.user_id())
+        return ndb.Key(Vote, vote_key)
+    
+    @classmethod
+    def insert(cls, round_key, game_key, user, card):
+        # Like get_or_insert, but also tells whether the vote is new, so that
+        # a repeated post is not counted twice.
+        key = cls.get_key(round_key, user)
+        vote = key.get()
+        if vote is not None:
+            return vote, False
+        @ndb.transactional
+        def insert():
+            vote = key.get()
+            if vote is not None:
+                return vote, False
+            vote = cls(
+                key = key,
+                game = game_key,
+                round = round_key,
+                user = user,
+                card = card
+            )
+            vote.put()
+            return vote, True
+        return insert()
+
+class GameArchive(ndb.Model):
+    MAX_SIZE = 900 * 1024
+    entities = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add = True)
+    
+    @staticmethod
+    def get_key(game_key):
+        return ndb.Key(GameArchive, 1, parent = game_key)
+    
+    @classmethod
+    def create(cls, game_key, entities):
+        adapter = ndb.ModelAdapter()
+        chunks = []
+        for entity in entities:
+            data = adapter.entity_to_pb(entity).Encode()
+            chunks.append(struct.pack('>I', len(data)))
+            chunks.append(data)
+        data = zlib.compress(''.join(chunks))
+        if len(data) > cls.MAX_SIZE:
             return None
-        return estimate
+        return cls(key = cls.get_key(game_key), entities = data)
+    
+    def get_entities(self, kind = None):
+        adapter = ndb.ModelAdapter()
+        data = zlib.decompress(self.entities)
+        entities = []
+        offset = 0
+        while offset < len(data):
+            size = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+            entity = adapter.pb_to_entity(entity_pb.EntityProto(data[offset:offset + size]))
+            offset += size
+            if kind is None or isinstance(entity, kind):
+                entities.append(entity)
+        return entities
+
+class GameSnapshot(object):
+    
+    def __init__(self, game, archive = None):
+        self.game = game
+        self.rpcs = 0
+        self.url = game.get_url()
+        self.deck = game.get_deck()
+        self.participants = []
+        self.users = []
+        self.stories = []
+        self.current_story = None
+        participants = self.fetch_async(game.get_participants())
+        stories = rounds = estimates = None
+        if archive is None:
+            stories = self.fetch_async(game.get_stories())
+            if game.current_story_id:
+                # The current story is known up front, so its rounds and
+                # estimates are queried together with the rest.
+                story_key = ndb.Key(Story, game.current_story_id, parent = game.key)
+                rounds = self.fetch_async(Round.query(ancestor = story_key).order(Round.created))
+                estimates = self.fetch_async(Estimate.query(ancestor = story_key).order(Estimate.created))
+        for participant in participants.get_result():
+            self.participants.append(ParticipantRecord(participant, self.url))
+            self.users.append(participant.user)
+        if archive is not None:
+            # Archived games are completed, so there is no current story
+            # whose rounds would be needed.
+            stories = sorted(archive.get_entities(Story), key = lambda story: story.created)
+        else:
+            stories = stories.get_result()
+        totals = []
+        for story in stories:
+            is_current = story.is_current(game)
+            record = StoryRecord(story, game, self.url, is_current)
+            if is_current and rounds is not None:
+                self.current_story = record
+                self.add_rounds(record, rounds.get_result(), estimates.get_result())
+            self.stories.append(record)
+            totals.append(story.estimate)
+        self.totals = get_totals(self.deck, totals)
+    
+    def add_rounds(self, record, round_entities, estimates):
+        rounds = {}
+        for round in round_entities:
+            rounds[round.key] = RoundRecord(round, record.url)
+            record.rounds.append(rounds[round.key])
+        cards = {}
+        for estimate in estimates:
+            round = rounds.get(estimate.key.parent())
+            if round:
+                round.estimates.append(EstimateRecord(estimate, round.completed, self.deck))
+                if round.completed:
+                    cards.setdefault(estimate.key.parent(), []).append(estimate.card)
+        open_keys = [round_key for round_key, round in rounds.items() if not round.completed]
+        if open_keys:
+            self.rpcs += 1
+            for round_key, votes in Round.get_votes_multi(open_keys, self.users).items():
+                round = rounds[round_key]
+                voters = set(estimate.user for estimate in round.estimates)
+                for vote in sorted(votes, key = lambda vote: vote.created):
+                    if vote.user.user_id() not in voters:
+                        round.estimates.append(EstimateRecord(vote, False, self.deck))
+        for round_key, stats in get_rounds_stats(self.deck, cards).items():
+            rounds[round_key].stats = stats
+    
+    def fetch_async(self, query):
+        self.rpcs += 1
+        return query.fetch_async()
+    
+    def get_participant_messages(self):
+        messages = []
+        for participant in self.participants:
+            message = participant.get_message()
+            messages.append(message)
+        return messages
+    
+    def get_story_messages(self):
+        messages = []
+        for story in self.stories:
+            message = story.get_message()
+            messages.append(message)
+        return messages
+    
+    def get_current_story_message(self):
+        if not self.current_story:
+            return None
+        return self.current_story.get_message()
+    
+    def get_message(self):
+        game = self.game
+        message = {
+            'id': game.key.id(),
+            'name': game.name,
+            'deck': self.deck.cards,
+            'completed': game.completed,
+            'user': game.user.user_id(),
+            'current_story': self.get_current_story_message(),
+            'url': self.url,
+            'participants': self.get_participant_messages(),
+            'stories': self.get_story_messages(),
+            'version': game.version,
+            'totals': self.totals,
+        }
+        return message
@@ -0,0 +1,199 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+try:
+    from functools import lru_cache
+except ImportError:
+    from functools32 import lru_cache
+import json
+import time
+import logging
+import threading
+from collections import Counter, deque
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+
+__all__ = [
+    'RequestProfile',
+    'ProfileStats',
+    'ProfilerMiddleware',
+    'get_profile',
+    'set_profile',
+    'get_profile_stats',
+]
+
+PROFILE_HEADER = 'X-Poker-Profile'
+
+PERCENTILES = (50, 90, 99)
+
+# Requests that match no route share one entry, so scanners probing random
+# paths cannot grow the stats without bound.
+UNMATCHED_ROUTE = '(unmatched)'
+
+_local = threading.local()
+
+def get_profile():
+    return getattr(_local, 'profile', None)
+
+def set_profile(profile):
+    _local.profile = profile
+
+def get_request_kinds(call, request):
+    # Only the datastore_v3 request types the app issues are inspected; any
+    # other call is reported without a kind.
+    try:
+        if call == 'RunQuery':
+            return [request.kind()]
+        if call == 'Put':
+            keys = [entity.key() for entity in request.entity_list()]
+        elif call in ('Get', 'Delete'):
+            keys = request.key_list()
+        else:
+            return ['*']
+        return sorted(set(key.path().element_list()[-1].type() for key in keys))
+    except Exception:
+        return ['*']
+
+class RequestProfile(object):
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.route = None
+        self.start = time.time()
+        self.duration = None
+        self.status = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.datastore = Counter()
+        self.datastore_time = 0.0
+        self.rpcs = Counter()
+        self.firebase = []
+        self.render_time = 0.0
+        self.firebase_bytes = 0
+        self.response_bytes = 0
+
+    def start_rpc(self, service, call, request):
+        with self.lock:
+            self.rpcs[service + '.' + call] += 1
+            if service == 'datastore_v3':
+                for kind in get_request_kinds(call, request):
+                    self.datastore[kind + '.' + call] += 1
+                self.pending[id(request)] = time.time()
+
+    def end_rpc(self, service, call, request):
+        with self.lock:
+            start = self.pending.pop(id(request), None)
+            if start is not None:
+                self.datastore_time += time.time() - start
+
+    def add_firebase(self, method, path, status, duration, size):
+        with self.lock:
+            self.firebase.append((method, path, status, duration))
+            self.firebase_bytes += size
+
+    def add_render(self, duration):
+        with self.lock:
+            self.render_time += duration
+
+    def finish(self, status):
+        self.status = status
+        self.duration = time.time() - self.start
+
+    def get_summary(self):
+        with self.lock:
+            return {
+                'method': self.method,
+                'route': self.route or UNMATCHED_ROUTE,
+                'path': self.path,
+                'status': self.status,
+                'time': round(self.duration * 1000, 1),
+                'rpcs': sum(self.rpcs.values()),
+                'datastore': dict(self.datastore),
+                'datastore_time': round(self.datastore_time * 1000, 1),
+                'firebase': len(self.firebase),
+                'firebase_time': round(sum(call[3] for call in self.firebase) * 1000, 1),
+                'firebase_bytes': self.firebase_bytes,
+                'render_time': round(self.render_time * 1000, 1),
+                'response_bytes': self.response_bytes,
+            }
+
+def pre_call_hook(service, call, request, response):
+    profile = get_profile()
+    if profile is not None:
+        profile.start_rpc(service, call, request)
+
+def post_call_hook(service, call, request, response):
+    profile = get_profile()
+    if profile is not None:
+        profile.end_rpc(service, call, request)
+
+class ProfileStats(object):
+    METRICS = ('time', 'rpcs', 'datastore_time', 'firebase', 'firebase_time', 'firebase_bytes', 'render_time', 'response_bytes')
+
+    def __init__(self, size = 1000):
+        self.size = size
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def add(self, summary):
+        key = summary['method'] + ' ' + summary['route']
+        with self.lock:
+            samples = self.routes.get(key)
+            if samples is None:
+                samples = self.routes[key] = deque(maxlen = self.size)
+            samples.append(tuple(summary[metric] for metric in self.METRICS))
+
+    def get_stats(self):
+        with self.lock:
+            routes = dict((key, list(samples)) for key, samples in self.routes.items())
+        stats = {}
+        for key, samples in routes.items():
+            route = {'count': len(samples)}
+            for index, metric in enumerate(self.METRICS):
+                values = sorted(sample[index] for sample in samples)
+                route[metric] = dict(
+                    ('p{}'.format(percentile), values[min(len(values) - 1, len(values) * percentile // 100)])
+                    for percentile in PERCENTILES
+                )
+            stats[key] = route
+        return stats
+
+@lru_cache()
+def get_profile_stats():
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('poker-profiler', pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('poker-profiler', post_call_hook)
+    return ProfileStats()
+
+class ProfilerMiddleware(object):
+
+    def __init__(self, application):
+        self.application = application
+        self.stats = get_profile_stats()
+
+    def __call__(self, environ, start_response):
+        profile = RequestProfile(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'))
+        set_profile(profile)
+        header = environ.get('HTTP_X_POKER_PROFILE')
+
+        def profile_start_response(status, headers, exc_info = None):
+            profile.finish(int(status.split(' ', 1)[0]))
+            if header and users.is_current_user_admin():
+                headers = list(headers) + [(PROFILE_HEADER, json.dumps(profile.get_summary()))]
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.application(environ, profile_start_response)
+            for chunk in body:
+                profile.response_bytes += len(chunk)
+                yield chunk
+            if hasattr(body, 'close'):
+                body.close()
+        finally:
+            set_profile(None)
+            if profile.duration is None:
+                profile.finish(500)
+            summary = profile.get_summary()
+            self.stats.add(summary)
+            logging.info('profile %s', json.dumps(summary, sort_keys = True))
@@ -0,0 +1,101 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+__all__ = [
+    'ParticipantRecord',
+    'StoryRecord',
+    'RoundRecord',
+    'EstimateRecord',
+]
+
+class ParticipantRecord(object):
+    __slots__ = ('user', 'name', 'photo', 'observer', 'url')
+
+    def __init__(self, participant, game_url):
+        self.user = participant.user.user_id()
+        self.name = participant.get_name()
+        self.photo = participant.photo
+        self.observer = participant.observer
+        self.url = game_url + '/participant/' + participant.key.id()
+
+    def get_message(self):
+        message = {
+            'user': self.user,
+            'name': self.name,
+            'photo': self.photo,
+            'observer': self.observer,
+            'url': self.url
+        }
+        return message
+
+class StoryRecord(object):
+    __slots__ = ('id', 'name', 'estimate', 'url', 'is_current', 'rounds')
+
+    def __init__(self, story, game, game_url, is_current):
+        self.id = story.key.id()
+        self.name = story.get_name_display()
+        self.estimate = story.get_estimate(game)
+        self.url = game_url + '/story/' + str(self.id)
+        self.is_current = is_current
+        self.rounds = []
+
+    def get_round_messages(self):
+        messages = []
+        for round in self.rounds:
+            message = round.get_message()
+            messages.append(message)
+        return messages
+
+    def get_message(self):
+        message = {
+            'id': self.id,
+            'name': self.name,
+            'estimate': self.estimate,
+            'url': self.url,
+            'is_current': self.is_current,
+            'rounds': self.get_round_messages(),
+        }
+        return message
+
+class RoundRecord(object):
+    __slots__ = ('id', 'completed', 'url', 'estimates', 'stats')
+
+    def __init__(self, round, story_url):
+        self.id = round.key.id()
+        self.completed = round.completed
+        self.url = story_url + '/round/' + str(self.id)
+        self.estimates = []
+        self.stats = None
+
+    def get_estimate_messages(self):
+        messages = []
+        for estimate in self.estimates:
+            message = estimate.get_message()
+            messages.append(message)
+        return messages
+
+    def get_message(self):
+        message = {
+            'id': self.id,
+            'completed': self.completed,
+            'url': self.url,
+            'estimates': self.get_estimate_messages(),
+            'stats': self.stats,
+        }
+        return message
+
+class EstimateRecord(object):
+    __slots__ = ('user', 'name', 'card')
+
+    def __init__(self, estimate, completed, deck):
+        self.user = estimate.user.user_id()
+        self.name = estimate.user.nickname()
+        self.card = deck.get_card(estimate.card) if completed else None
+
+    def get_message(self):
+        message = {
+            'user': self.user,
+            'name': self.name,
+            'card': self.card,
+        }
+        return message
@@ -0,0 +1,66 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+from collections import Counter
+
+__all__ = [
+    'get_round_stats',
+    'get_rounds_stats',
+    'get_totals',
+]
+
+def get_median(values):
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def get_mode(values):
+    counts = Counter(values)
+    return min(counts, key = lambda value: (-counts[value], value))
+
+def get_round_stats(deck, cards):
+    counts = [0] * len(deck.cards)
+    for card in cards:
+        if deck.has_card(card):
+            counts[card] += 1
+    values = sorted(deck.values[card] for card in cards if deck.get_value(card) is not None)
+    stats = {
+        'votes': len(cards),
+        'counts': counts,
+        'consensus': len(cards) > 0 and len(set(cards)) == 1,
+        'mean': None,
+        'median': None,
+        'mode': None,
+        'min': None,
+        'max': None,
+        'spread': None,
+    }
+    if values:
+        stats['mean'] = round(sum(values) / len(values), 2)
+        stats['median'] = round(get_median(values), 2)
+        stats['mode'] = get_mode(values)
+        stats['min'] = values[0]
+        stats['max'] = values[-1]
+        stats['spread'] = values[-1] - values[0]
+    return stats
+
+def get_rounds_stats(deck, rounds):
+    return dict((round_id, get_round_stats(deck, cards)) for round_id, cards in rounds.items())
+
+def get_totals(deck, estimates):
+    totals = {
+        'stories': len(estimates),
+        'estimated': 0,
+        'estimate': 0,
+    }
+    for card in estimates:
+        if card is None or card < 0:
+            continue
+        totals['estimated'] += 1
+        value = deck.get_value(card)
+        if value:
+            totals['estimate'] += value
+    return totals
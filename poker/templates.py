@@ -0,0 +1,73 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+
+import jinja2
+
+__all__ = [
+    'JINJA2_VERSION',
+    'TEMPLATES_PATH',
+    'COMPILED_TEMPLATES_PATH',
+    'create_environment',
+    'create_loader',
+    'compile_templates',
+]
+
+TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+COMPILED_TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates_compiled')
+
+# Compiled templates only run on the jinja2 that compiled them, so this has to
+# match the version pinned in app.yaml.
+JINJA2_VERSION = '2.6'
+
+VERSION_FILE = 'JINJA2_VERSION'
+
+def create_environment(loader):
+    return jinja2.Environment(
+        loader = loader,
+        extensions = [
+            'jinja2.ext.autoescape',
+        ],
+        autoescape = True
+    )
+
+class FallbackLoader(jinja2.FileSystemLoader):
+    # Only asked for the templates missing from the compiled modules.
+
+    def get_source(self, environment, template):
+        logging.warning('Template %s was not compiled, parsing its source', template)
+        return super(FallbackLoader, self).get_source(environment, template)
+
+def get_compiled_version(target = COMPILED_TEMPLATES_PATH):
+    try:
+        with open(os.path.join(target, VERSION_FILE)) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def create_loader(compiled = None):
+    if compiled is None:
+        # The development server always reads the sources so edits show up
+        # without recompiling.
+        development = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+        compiled = not development and os.path.isdir(COMPILED_TEMPLATES_PATH)
+        if not development and not compiled:
+            logging.warning('No compiled templates in %s, parsing the sources', os.path.normpath(COMPILED_TEMPLATES_PATH))
+        elif compiled and get_compiled_version() != jinja2.__version__:
+            logging.warning('Templates were compiled with jinja2 %s but %s is running, parsing the sources', get_compiled_version(), jinja2.__version__)
+            compiled = False
+    if compiled:
+        return jinja2.ChoiceLoader([
+            jinja2.ModuleLoader(COMPILED_TEMPLATES_PATH),
+            FallbackLoader(TEMPLATES_PATH),
+        ])
+    return jinja2.FileSystemLoader(TEMPLATES_PATH)
+
+def compile_templates(target = COMPILED_TEMPLATES_PATH):
+    environment = create_environment(jinja2.FileSystemLoader(TEMPLATES_PATH))
+    environment.compile_templates(target, zip = None, py_compile = False)
+    with open(os.path.join(target, VERSION_FILE), 'w') as f:
+        f.write(jinja2.__version__)
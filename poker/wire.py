@@ -0,0 +1,132 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+from google.appengine.api import memcache
+
+__all__ = [
+    'LEGACY_FORMAT',
+    'COMPACT_FORMAT',
+    'encode_message',
+    'get_wire_format',
+    'set_client_format',
+    'get_published',
+    'set_published',
+    'lock_publish',
+    'unlock_publish',
+]
+
+LEGACY_FORMAT = 1
+
+COMPACT_FORMAT = 2
+
+LEGACY_TIMEOUT = 15 * 60
+
+PUBLISH_TIMEOUT = 10
+
+class UserTable(object):
+
+    def __init__(self):
+        self.users = []
+        self.indexes = {}
+
+    def intern(self, user_id, name):
+        index = self.indexes.get(user_id)
+        if index is None:
+            index = self.indexes[user_id] = len(self.users)
+            self.users.append([user_id, name])
+        elif self.users[index][1] is None:
+            self.users[index][1] = name
+        return index
+
+def compact(entry, **values):
+    # Firebase drops null values, so absent keys stand for null, false and
+    # empty lists.
+    for key, value in values.items():
+        if value is not None and value is not False and value != []:
+            entry[key] = 1 if value is True else value
+    return entry
+
+def encode_participant(users, participant):
+    index = users.intern(participant['user'], participant['name'])
+    return compact({'u': index},
+        n = participant['name'] if users.users[index][1] != participant['name'] else None,
+        p = participant['photo'],
+        o = participant['observer']
+    )
+
+def encode_estimate(users, estimate):
+    index = users.intern(estimate['user'], estimate['name'])
+    return compact({'u': index},
+        n = estimate['name'] if users.users[index][1] != estimate['name'] else None,
+        c = estimate['card']
+    )
+
+def encode_round(users, round):
+    return compact({'i': round['id']},
+        c = round['completed'],
+        e = [encode_estimate(users, estimate) for estimate in round['estimates']],
+        s = round.get('stats')
+    )
+
+def encode_story(users, story, rounds = False):
+    entry = compact({'i': story['id'], 'n': story['name']}, e = story['estimate'])
+    if rounds:
+        compact(entry, r = [encode_round(users, round) for round in story['rounds']])
+    return entry
+
+def encode_compact(message):
+    users = UserTable()
+    participants = [encode_participant(users, participant) for participant in message['participants']]
+    stories = [encode_story(users, story) for story in message['stories']]
+    current_story = None
+    if message['current_story']:
+        current_story = encode_story(users, message['current_story'], rounds = True)
+    owner = users.intern(message['user'], None)
+    return compact({'f': COMPACT_FORMAT, 'i': message['id'], 'n': message['name'], 'u': owner, 'v': message['version']},
+        c = message['completed'],
+        us = users.users,
+        p = participants,
+        s = stories,
+        cs = current_story,
+        t = message.get('totals')
+    )
+
+def encode_message(message, format = COMPACT_FORMAT):
+    if format == COMPACT_FORMAT:
+        return encode_compact(message)
+    return message
+
+def get_legacy_key(game_id):
+    return 'wire:legacy:{}'.format(game_id)
+
+def get_published_key(game_id):
+    return 'wire:published:{}'.format(game_id)
+
+def get_publish_lock_key(game_id):
+    return 'wire:publishing:{}'.format(game_id)
+
+def set_client_format(game_id, format):
+    # Pages opened before the compact format existed do not announce one and
+    # can only read the legacy messages.
+    if format < COMPACT_FORMAT:
+        memcache.set(get_legacy_key(game_id), True, time = LEGACY_TIMEOUT)
+
+def get_wire_format(game_id):
+    if memcache.get(get_legacy_key(game_id)):
+        return LEGACY_FORMAT
+    return COMPACT_FORMAT
+
+def get_published(game_id):
+    published = memcache.get(get_published_key(game_id))
+    if not isinstance(published, tuple):
+        return None, 0
+    return published
+
+def set_published(game_id, format, version):
+    memcache.set(get_published_key(game_id), (format, version))
+
+def lock_publish(game_id):
+    return memcache.add(get_publish_lock_key(game_id), True, time = PUBLISH_TIMEOUT)
+
+def unlock_publish(game_id):
+    memcache.delete(get_publish_lock_key(game_id))